@@ -7,16 +7,15 @@ Generate HAproxy Configuration based on AWS and Openstack API (Nova).
 Leverage Jinja2 for templating.
 """
 
-import logging, sys, re
+import logging, os, sys, re
 import click
-import daemon
-import daemon.pidfile
-from time import sleep
-
-import boto.ec2
-from novaclient import client
 
 from havoc.core import Havoc
+from havoc.metrics import start_metrics_server
+from havoc.outputs import load_outputs
+from havoc.providers import connect_providers
+from havoc.scheduler import Scheduler, parse_pool_settings, time_str_to_sec
+from havoc.share import start_share_server
 from havoc.config import Config
 
 
@@ -32,24 +31,28 @@ def get_logger(output, debug):
     logger.addHandler(output)
     return logger
 
-def time_str_to_sec(time):
-    w = {
-        'sec': 1,
-        'min': 60,
-        'hour': 3600
-    }
-    res = re.match(r"(\d+)(\w+)", time)
-    if res is not None and len(res.groups()) == 2:
-        return int(res.group(1))*int(w[res.group(2)])
-    # Default on 5min
-    return 300
-
-def run_daemon(havoc, log, run_every='5min'):
-    while True:
-        havoc.run()
-        nextrun = time_str_to_sec(run_every)
-        log.debug("Wait for next run : %d sec", nextrun)
-        sleep(nextrun)
+def cycle_interval(havoc, run_every):
+    # Cycles run as often as the pool refreshed the most often
+    return min([time_str_to_sec(run_every)] + [settings[0] for settings in havoc.get_pool_settings().values()])
+
+def run_daemon(havoc, log, run_every='5min', jitter=0, backoff_max=None, watch=None, on_change=None):
+    def files_changed(changed):
+        if on_change is not None:
+            on_change(changed)
+        scheduler.interval = cycle_interval(havoc, havoc.options.get('interval') or run_every)
+
+    scheduler = Scheduler(havoc, log, cycle_interval(havoc, run_every),
+            jitter=time_str_to_sec(jitter) if jitter else 0,
+            backoff_max=time_str_to_sec(backoff_max) if backoff_max else None,
+            watch=watch, on_change=files_changed)
+    if havoc.options.get('metrics_port'):
+        start_metrics_server(havoc.metrics, havoc.options['metrics_port'], havoc.options.get('metrics_address') or '127.0.0.1')
+        log.info("Serving metrics on %s:%d", havoc.options.get('metrics_address'), havoc.options['metrics_port'])
+    if havoc.publisher is not None:
+        start_share_server(havoc.publisher, havoc.options['share_port'], havoc.options.get('share_address') or '127.0.0.1')
+        log.info("Sharing the inventory on %s:%d", havoc.options.get('share_address'), havoc.options['share_port'])
+    havoc.warm_start()
+    scheduler.run_forever()
 
 
 @click.command()
@@ -57,10 +60,46 @@ def run_daemon(havoc, log, run_every='5min'):
 @click.option('--cli', is_flag=True, help="Run HAvOC as a command without daemon")
 @click.option('--daemonize', is_flag=True, help="Start the HAvOC daemon")
 @click.option('--interval', default='5min', help="Define the interval between every run")
+@click.option('--jitter', default=None, help="Maximum random delay added to every interval (ie. 30sec)")
+@click.option('--backoff-max', default=None, help="Maximum interval when providers fail (default: 8 intervals)")
 @click.option('--pidfile', default='/var/run/havoc.pid', help="Define the pidfile when running as daemon")
 @click.option('--template', default='/etc/haproxy/haproxy.cfg.tmpl', help="Jinja 2 template")
+@click.option('--template-cache-dir', default=None, help="Directory for the compiled templates cache")
+@click.option('--output', multiple=True, help="Extra output rendered every cycle : TEMPLATE:PATH[:noreload|:map] or json:PATH")
 @click.option('--haproxy-cfg', default='/etc/haproxy/haproxy.cfg', help="The HAproxy configuration file")
+@click.option('--validate-cmd', default=None, help="Command validating a new configuration, given its path as last argument (ie. haproxy -c -f)")
 @click.option('--pools', required=True, default='', help="List of HAproxy Backend Pools")
+@click.option('--discovery-workers', default=0, help="Number of concurrent provider lookups (0 for serial discovery)")
+@click.option('--discovery-timeout', default=30, help="Timeout in seconds for each provider lookup in concurrent discovery")
+@click.option('--discovery-deadline', default=0, help="Seconds after which no provider request is started in a cycle (0 to disable)")
+@click.option('--api-rate', default=0.0, help="Provider requests per second per provider and region (0 for unlimited)")
+@click.option('--api-burst', default=5, help="Provider requests allowed in a burst")
+@click.option('--api-retries', default=4, help="Retries of a throttled provider request")
+@click.option('--preflight', default=None, help="Probe new backends before adding them to the configuration : tcp or http")
+@click.option('--preflight-port', default=80, help="Port probed when a backend has no port tag")
+@click.option('--preflight-path', default='/', help="Path of the HEAD request of the http pre-flight check")
+@click.option('--preflight-timeout', default=2, help="Timeout in seconds of a pre-flight check")
+@click.option('--preflight-concurrency', default=100, help="Maximum number of concurrent pre-flight checks")
+@click.option('--preflight-mark', is_flag=True, help="Keep backends failing their pre-flight check, only marking them in the ready variable")
+@click.option('--runtime-api', is_flag=True, help="Apply membership-only changes through the HAproxy stats sockets instead of reloading")
+@click.option('--haproxy-sockets', default=None, help="List of HAproxy admin stats sockets (default: read from the configuration)")
+@click.option('--runtime-timeout', default=2, help="Timeout in seconds for the HAproxy Runtime API")
+@click.option('--reload-min-interval', default=0, help="Minimum number of seconds between two HAproxy reloads")
+@click.option('--reload-max', default=0, help="Maximum number of HAproxy reloads per reload window (0 for unlimited)")
+@click.option('--reload-window', default=3600, help="Length in seconds of the reload window")
+@click.option('--backend-tags', default=None, help="List of tags/metadata kept on backends for the template (default: all)")
+@click.option('--snapshot-file', default=None, help="Inventory snapshot used when a provider fails or is slow")
+@click.option('--snapshot-max-age', default=3600, help="Maximum age in seconds of the snapshot data served")
+@click.option('--slot-spares', default=0, help="Number of spare disabled server slots kept in every pool")
+@click.option('--slots-file', default=None, help="File keeping the server slots of every pool across restarts")
+@click.option('--provider-budget', default=0, help="Seconds before a slow provider is served from the snapshot (0 to disable)")
+@click.option('--metrics-port', default=0, help="Port of the Prometheus metrics listener (0 to disable)")
+@click.option('--metrics-address', default='127.0.0.1', help="Address of the Prometheus metrics listener")
+@click.option('--metrics-textfile', default=None, help="Write the metrics to this node-exporter textfile")
+@click.option('--share-port', default=0, help="Port publishing the inventory to followers (0 to disable)")
+@click.option('--share-address', default='127.0.0.1', help="Address publishing the inventory to followers")
+@click.option('--leader-url', default=None, help="Follow the inventory published by a leader (ie. http://leader:8090/inventory)")
+@click.option('--leader-timeout', default=10, help="Timeout in seconds when fetching the leader inventory")
 @click.option('--cpus', default=1, help="Reserved CPUS for HAproxy (nbproc)")
 @click.option('--system-cpus', default=0, help="Reserved CPUS for the system")
 @click.option('--log-send-hostname', default=None, help="Hostname for the syslog header")
@@ -69,6 +108,9 @@ def run_daemon(havoc, log, run_every='5min'):
 @click.option('--overflow-aws-region', default=None, help="Overflow AWS region")
 @click.option('--overflow-aws-zone', default=None, help="Overflow AWS zone")
 @click.option('--aws-vpc', default=None, help="AWS VPC name")
+@click.option('--aws-regions', default=None, help="Comma separated AWS regions queried with the same credentials")
+@click.option('--aws-region-timeout', default=0, help="Seconds before a slow AWS region is given up for the cycle (0 to disable)")
+@click.option('--static-file', default=None, help="YAML file listing static backends of every pool")
 @click.option('--os-auth-url', default=None, help="Openstack Auth URL")
 @click.option('--os-username', default=None, help="Openstack Username")
 @click.option('--os-api-key', default=None, help="Openstack API Key")
@@ -102,31 +144,54 @@ def cli(**options):
         log.error("Pools is not defined. Please use --pools or pools in the configuration file")
         sys.exit(1)
 
-    # Defining regions
-    ec2 = None
-    aws_region = config.get('overflow_aws_region') if config.get('overflow_aws_region') else "us-east-1"
-    nova = None
+    # Setup providers. Client libraries are only imported for the configured ones
+    providers = connect_providers(config, log)
 
-    # Setup providers
-    if config.get('aws_access_key_id') is not None:
-        log.debug("Creating EC2 Provider, AWS Key ID: %s", config.get('aws_access_key_id'))
-        ec2 = boto.ec2.connect_to_region(
-                aws_region, aws_access_key_id=config.get('aws_access_key_id'), aws_secret_access_key=config.get('aws_secret_access_key')
-                )
+    options['pool_settings'] = config.get('pool_settings')
+    try:
+        parse_pool_settings(options['pool_settings'])
+    except ValueError as e:
+        log.error("Invalid pool_settings : %s", e)
+        sys.exit(1)
 
-    if config.get('os_username') is not None:
-        log.debug("Creating Openstack Provider, User: %s", config.get('os_username'))
-        nova = client.Client("2",
-                auth_url=config.get('os_auth_url'), username=config.get('os_username'), api_key=config.get('os_password'), project_id=config.get('os_project_id')
-                )
+    try:
+        options['outputs'] = load_outputs(config.get('output'), config.get('outputs'))
+    except (KeyError, ValueError) as e:
+        log.error("Invalid output : %s", e)
+        sys.exit(1)
 
-    havoc = Havoc(ec2, nova, options, log)
+    havoc = Havoc(providers.get('ec2'), providers.get('openstack'), options, log, providers.get('static'), providers.get('leader'))
 
     if config.get('cli'):
         sys.exit(havoc.run())
 
+    def reload_config(changed):
+        if os.path.abspath(options['config']) not in changed:
+            return
+        new_config = Config(options, options['config'])
+        new_options = dict(new_config.get_config())
+        new_options['pool_settings'] = new_config.get('pool_settings')
+        try:
+            parse_pool_settings(new_options['pool_settings'])
+            new_options['outputs'] = load_outputs(new_config.get('output'), new_config.get('outputs'))
+        except (KeyError, ValueError) as e:
+            log.error("Invalid configuration, keeping the current one : %s", e)
+            return
+        havoc.reload_options(new_options)
+
+    scheduler_options = {
+        'run_every': config.get('interval'),
+        'jitter': config.get('jitter'),
+        'backoff_max': config.get('backoff_max'),
+        'watch': [os.path.abspath(path) for path in (config.get('template'), options['config']) if path],
+        'on_change': reload_config,
+    }
+
     if config.get('daemonize'):
         try:
+            import daemon
+            import daemon.pidfile
+
             daemon_context = daemon.DaemonContext(
                 pidfile=daemon.pidfile.PIDLockFile(config.get('pidfile')),
                 stderr=sys.stderr,
@@ -134,12 +199,12 @@ def cli(**options):
                 files_preserve=[log_handler.stream]
             )
             with daemon_context:
-                run_daemon(havoc, log, run_every=config.get('interval'))
+                run_daemon(havoc, log, **scheduler_options)
         except Exception as e:
             log.error("Daemonize failed. Exiting : %s", e)
             sys.exit(1)
     else:
-        run_daemon(havoc, log, run_every=config.get('interval'))
+        run_daemon(havoc, log, **scheduler_options)
 
 
 if __name__ == '__main__':
@@ -9,132 +9,588 @@ Generate HAproxy Configuration based on AWS and Openstack API (Nova). Leverage J
 import logging, os, sys, re
 
 from subprocess import call
+import shlex
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple
+from functools import partial
 import hashlib
+import time
 import jinja2
-from jinja2 import Environment, PackageLoader
 
-import boto.ec2
-from novaclient import client
-
-from havoc.filters.match import filter_match_dict
+from havoc.filters import render_scope
+from havoc.governor import ReloadGovernor
+from havoc.inventory import diff_inventory, fingerprint, inventory_index
+from havoc.metrics import build_metrics
+from havoc.records import from_ec2_instance, from_os_server
+from havoc.slots import SlotAllocator
+from havoc.snapshot import Snapshot
+from havoc.outputs import render_json
+from havoc.preflight import Preflight
+from havoc.providers.ec2 import EC2Account
+from havoc.share import InventoryPublisher
+from havoc.scheduler import parse_pool_settings, time_str_to_sec
+from havoc.runtime import RuntimeAPI, RuntimeAPIError, find_stats_sockets, plan_map_commands, plan_runtime_commands
+from havoc.throttle import Throttle
+from havoc.templating import build_environment, template_stamp
+
+# Maximum number of results per DescribeInstances page
+EC2_PAGE_SIZE = 1000
+# Maximum number of servers per Nova listing page
+OS_PAGE_SIZE = 500
+
+
+def get_os_fixed_ip(server):
+    """
+    Return the first fixed IP of a server, networks being sorted by name
+    """
+    for net in sorted(server.addresses):
+        for conf in server.addresses[net]:
+            if conf.get('OS-EXT-IPS:type') == 'fixed':
+                return conf['addr']
+    return None
+
+
+def file_digest(path, block_size=65536):
+    """
+    Return the md5 of a file, read by blocks
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as handle:
+        for block in iter(partial(handle.read, block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stream_to_temp(path, chunks):
+    """
+    Write text chunks to a temporary file in the directory of path (of its
+    target when path is a symlink), hashing them on the fly. Return
+    (temporary path, md5, size in bytes).
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.realpath(path)), prefix='.havoc-')
+    digest = hashlib.md5()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            for chunk in chunks:
+                data = chunk.encode()
+                digest.update(data)
+                size += len(data)
+                handle.write(data)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
+
+# A provider lookup run during discovery. provider is the key of its results
+# in the inventory snapshot.
+Lookup = namedtuple('Lookup', ['provider', 'label', 'func', 'args', 'timeout'])
 
 
 class Havoc(object):
 
-    def __init__(self, ec2, nova, options, log):
+    def __init__(self, ec2, nova, options, log, static=None, leader=None):
         self.ec2 = ec2
         self.nova = nova
+        self.static = static
+        # Followers only read the inventory of their leader
+        self.leader = leader
+        if isinstance(ec2, (list, tuple)):
+            self.ec2_accounts = list(ec2)
+        else:
+            self.ec2_accounts = [EC2Account(ec2, zone=options.get('overflow_aws_zone'))]
         self.log = log
         self.options = options
+        self.jinja_env = None
+        self.metrics = build_metrics(self.options)
+        self.governor = ReloadGovernor()
+        # State of the last generated configuration
+        self.last_index = None
+        self.last_fingerprint = None
+        self.last_template_stamp = None
+        # Digest of the last written content of every output file
+        self.digests = {}
+        # Set when an extra output changed and needs a HAproxy reload
+        self.outputs_need_reload = False
+        self.last_delta = {}
+        self.last_instances = None
+        self.discovery_errors = 0
+        self.stale_pools = {}
+        # Pools a provider failed for without any usable snapshot
+        self.unavailable_pools = set()
+        # Providers whose lookup went over budget and is still running
+        self.refreshing = set()
+        self.snapshot = None
+        if self.options.get('snapshot_file'):
+            self.snapshot = Snapshot(self.options['snapshot_file'], self.log)
+            self.snapshot.load()
+        self.slot_allocator = None
+        self.publisher = InventoryPublisher() if self.options.get('share_port') else None
+        # Request layer of every provider/region, and the timestamp provider
+        # requests may not start after during the current discovery
+        self.throttles = {}
+        self.cycle_deadline = None
+        # Per pool cache of the last refresh : {pool: [Backend]} and {pool: timestamp}
+        self.pool_cache = {}
+        self.pool_refreshed = {}
+        # Backends of the last discovery of every pool : {pool: {provider: count}}
+        self.backend_counts = {}
+        # Pre-flight checks of the new backends, and their result {pool: {name: ready}}
+        self.preflight = None
+        self.ready = {}
+        self.apply_options()
+
+    def apply_options(self):
+        """
+        Build the objects derived from the options : reload governor limits,
+        request layers, outputs, server slots and pre-flight checks
+        """
+        self.backend_tags = self.options['backend_tags'].split(',') if self.options.get('backend_tags') else None
+        # The reload history and a pending reload are kept
+        self.governor.min_interval = self.options.get('reload_min_interval') or 0
+        self.governor.max_reloads = self.options.get('reload_max') or 0
+        self.governor.window = self.options.get('reload_window') or 3600
+        self.throttles = {}
+        self.outputs = self.options.get('outputs') or []
+
+        slot_allocator = SlotAllocator(self.options.get('slot_spares') or 0, self.options.get('slots_file'), self.log)
+        if not slot_allocator.load() and self.slot_allocator is not None:
+            slot_allocator.pools = self.slot_allocator.pools
+        self.slot_allocator = slot_allocator
+
+        healthy = self.preflight.healthy if self.preflight is not None else set()
+        self.preflight = None
+        if self.options.get('preflight'):
+            self.preflight = Preflight(self.options['preflight'],
+                                       port=self.options.get('preflight_port') or 80,
+                                       path=self.options.get('preflight_path') or '/',
+                                       timeout=self.options.get('preflight_timeout') or 2,
+                                       concurrency=self.options.get('preflight_concurrency') or 100,
+                                       log=self.log)
+            self.preflight.healthy = healthy
+
+    def reload_options(self, options):
+        """
+        Apply a new configuration. The next render writes the configuration
+        again, and discovers the pools again when they changed.
+        """
+        pools = self.options.get('pools')
+        self.options.update(options)
+        self.apply_options()
+        self.last_fingerprint = None
+        if self.options.get('pools') != pools:
+            self.last_instances = None
+
+    def get_template(self, template):
+        """
+        Return the compiled template, recompiled only when the file changed
+        """
+        if self.jinja_env is None:
+            self.jinja_env = build_environment(self.options.get('template_cache_dir'))
+        return self.jinja_env.get_template(os.path.abspath(template))
 
 
     def get_ec2_instances_in_pool(self, pool, suffix):
-        self.log.debug("AWS EC2 : Trying to find vm in %s", pool)
-        instances = []
-        if self.ec2 is None:
-            self.log.debug('EC2 provider is not setup. No instances will be returned for this pool : %s', pool)
+        return self.get_ec2_instances_by_pool([pool], suffix)[pool]
+
+    def get_ec2_instances_by_pool(self, pools, suffix):
+        try:
+            return self.list_ec2_instances_by_pool(pools, suffix)
+        except Exception as e:
+            self.log.error("Error listing instances for EC2 : %s", e)
+            self.discovery_errors += 1
+            return dict((pool, []) for pool in pools)
+
+    def list_ec2_instances_by_pool(self, pools, suffix, account=None):
+        """
+        Retrieve the running instances of all the pools with a single paginated
+        DescribeInstances sweep per account and split them locally by their
+        pool tag. All the accounts are queried when account is None.
+        """
+        if account is None:
+            instances = dict((pool, []) for pool in pools)
+            for account in self.ec2_accounts:
+                for pool, found in self.list_ec2_instances_by_pool(pools, suffix, account).items():
+                    instances[pool].extend(found)
             return instances
 
+        self.log.debug("%s : Trying to find vm in %s", account.label, ','.join(pools))
+        instances = dict((pool, []) for pool in pools)
+        if account.connection is None:
+            self.log.debug('EC2 provider is not setup. No instances will be returned for these pools : %s', ','.join(pools))
+            return instances
 
-        filters = {'tag:pool': pool,'instance-state-name': 'running'}
+        filters = {'tag:pool': list(pools), 'instance-state-name': 'running'}
 
         if self.options['aws_vpc'] is not None:
             filters['tag:vpc'] = self.options['aws_vpc']
 
-        if self.options['overflow_aws_zone'] is not None:
-            filters['availability_zone'] = self.options['overflow_aws_zone']
+        if account.zone is not None:
+            filters['availability_zone'] = account.zone
+
+        next_token = None
+        while True:
+            res = self.call_provider(account.provider, account.connection.get_all_reservations,
+                                     filters=filters, max_results=EC2_PAGE_SIZE, next_token=next_token)
+            for r in res:
+                for i in r.instances:
+                    pool = i.tags.get('pool')
+                    if pool not in instances:
+                        continue
+                    instances[pool].append(from_ec2_instance(i, pool, suffix, self.backend_tags, account.region))
+            next_token = res.next_token
+            if not next_token:
+                break
 
-        try:
-            res = self.ec2.get_all_instances(filters=filters)
-        except Exception as e:
-            self.log.error("Error listing instances for EC2 : %s", e)
-            return instances
-
-        for r in res:
-            for i in r.instances:
-                if 'hostname' in i.tags:
-                    i.name = i.tags['hostname'] if suffix is None else i.tags['hostname'] + suffix
-                else:
-                    i.name = i.public_dns_name
-                instances.append(i)
         return instances
 
     def get_os_instances_in_pool(self, pool, suffix=None):
-        self.log.debug("Openstack : Trying to find vm in %s", pool)
-        instances = []
+        return self.get_os_instances_by_pool([pool], suffix)[pool]
+
+    def get_os_instances_by_pool(self, pools, suffix=None):
+        """
+        Retrieve the servers of all the pools with a single paginated listing
+        and index them by their pool metadata. Each server is returned once.
+        """
+        self.log.debug("Openstack : Trying to find vm in %s", ','.join(pools))
+        instances = dict((pool, []) for pool in pools)
         if self.nova is None:
-            self.log.debug('Nova provider is not setup. No instances will be returned for this pool : %s', pool)
+            self.log.debug('Nova provider is not setup. No instances will be returned for these pools : %s', ','.join(pools))
             return instances
 
         # TODO: Need to use --os-tenant option
-        res = self.nova.servers.list(search_opts={'metadata': u'{"pool":"%s"}'%pool, 'all_tenants': 0})
-        for i in res:
+        for i in self._iter_os_servers({'all_tenants': 0}):
             try:
-                for net, confs in i.addresses.items():
-                    for conf in confs:
-                        if conf['OS-EXT-IPS:type'] == 'fixed':
-                            i.ip_address = conf['addr']
-                            i.name = i.name if suffix is None else i.name + suffix
-                            if 'pool' in i.metadata and i.metadata['pool'] == pool:
-                                self.log.debug("Found instances %s for pool %s", i.name, pool)
-                                instances.append(i)
+                pool = i.metadata.get('pool')
+                ip_address = get_os_fixed_ip(i)
             except Exception as e:
                 self.log.debug('Cannot get information for the instances: %s', e)
-                pass
+                continue
+            if pool not in instances:
+                continue
+            if ip_address is None:
+                self.log.debug('Cannot find a fixed IP for the instance %s', i.name)
+                continue
+            backend = from_os_server(i, pool, ip_address, suffix, self.backend_tags)
+            self.log.debug("Found instances %s for pool %s", backend.name, pool)
+            instances[pool].append(backend)
         return instances
 
+    def _iter_os_servers(self, search_opts):
+        """
+        Stream the servers page by page, using the last server as marker.
+        """
+        marker = None
+        while True:
+            page = self.call_provider('openstack', self.nova.servers.list, search_opts=search_opts, marker=marker, limit=OS_PAGE_SIZE)
+            for i in page:
+                yield i
+            if len(page) < OS_PAGE_SIZE:
+                break
+            marker = page[-1].id
+
+    def get_throttle(self, provider):
+        """
+        Return the request layer of a provider/region
+        """
+        if provider not in self.throttles:
+            self.throttles[provider] = Throttle(provider,
+                                                rate=self.options.get('api_rate') or 0,
+                                                burst=self.options.get('api_burst') or 1,
+                                                retries=self.options.get('api_retries') or 0,
+                                                on_throttle=self._throttled)
+        return self.throttles[provider]
+
+    def _throttled(self, throttle, error, delay):
+        self.log.warning("%s is throttled, retrying in %.1f sec at %.2f req/s : %s", throttle.name, delay, throttle.current_rate(), error)
+        self.metrics.inc('havoc_api_throttled_total', provider=throttle.name)
+
+    def call_provider(self, provider, func, *args, **kwargs):
+        """
+        Call a provider API through the request layer of the provider
+        """
+        return self.get_throttle(provider).call(func, *args, deadline=self.cycle_deadline, **kwargs)
 
     #TODO: The hostname should be part of an optional parameter array
-    def build_haproxy_conf(self, template, instances, hostname, cpu_count, cpu_reserved):
+    def build_haproxy_conf(self, template, instances, hostname, cpu_count, cpu_reserved, context=None):
         try:
-            with open(template, 'r') as handle:
-                template_source = handle.read()
-        except Exception as e:
+            template = self.get_template(template)
+        except jinja2.TemplateNotFound as e:
             self.log.error("Error opening template : %s", e)
             return False
-        handle.close()
-
-        jinja_env = Environment()
-        #TODO: filters should be automatically discovered
-        jinja_env.filters['match'] = filter_match_dict
-
-        try:
-            template = jinja_env.from_string(template_source)
-            template_data = template.render(instances=instances, hostname=hostname, cpu_count=cpu_count, cpu_reserved=cpu_reserved)
         except Exception as e:
-            self.log.error("Cannot render the configuration : %s", e)
+            self.log.error("Cannot compile the template : %s", e)
             return False
 
+        path = self.options['haproxy_cfg']
+        variables = dict(instances=instances, hostname=hostname, cpu_count=cpu_count, cpu_reserved=cpu_reserved)
+
         if self.options['dry_run']:
+            try:
+                with self.metrics.timer('havoc_render_seconds'), render_scope():
+                    template_data = template.render(context or {}, **variables)
+            except Exception as e:
+                self.log.error("Cannot render the configuration : %s", e)
+                return False
+            self.metrics.set('havoc_config_bytes', len(template_data))
             self.log.info("Dry run. HAproxy configuration :\n%s", template_data)
             return True
 
-        if self.do_we_have_changes(template_data):
-            self.log.debug('Writing HAproxy configuration to file : %s and reloading HAproxy service', self.options['haproxy_cfg'])
+        # The configuration is streamed to a temporary file next to the
+        # HAproxy one and only moved in place when it changed and is valid
+        try:
+            with self.metrics.timer('havoc_render_seconds'), render_scope():
+                tmp_path, digest, size = stream_to_temp(path, template.generate(context or {}, **variables))
+        except Exception as e:
+            self.log.error("Cannot render the configuration : %s", e)
+            return False
+        self.metrics.set('havoc_config_bytes', size)
+
+        if not self.digest_changed(digest, path):
+            os.unlink(tmp_path)
+            self.log.debug('No changes in HAproxy configuration : %s', path)
+            self.metrics.inc('havoc_changes_total', result='unchanged')
+            if self.outputs_need_reload:
+                return self.request_reload()
+            return self.flush_reload()
+
+        if not self.validate_config(tmp_path):
+            os.unlink(tmp_path)
+            self.metrics.inc('havoc_changes_total', result='invalid')
+            return False
+        self.metrics.inc('havoc_changes_total', result='changed')
+
+        self.log.debug('Writing HAproxy configuration to file : %s and reloading HAproxy service', path)
+        previous_data = None
+        # The running HAproxy does not match the file while a reload is pending
+        if self.options.get('runtime_api') and not self.governor.pending:
             try:
-                with open(self.options['haproxy_cfg'], 'w') as config:
-                    config.write(template_data)
-                    config.close()
+                with open(path, 'r') as config:
+                    previous_data = config.read()
             except Exception as e:
-                self.log.error("Error while manipulating haproxy.cfg :\n%s", e)
-                return False
+                self.log.debug("Cannot read the previous HAproxy configuration : %s", e)
+        if not self.install_config(tmp_path, path, digest):
+            return False
 
-            return self.reload_haproxy()
+        if previous_data is not None and not self.outputs_need_reload:
+            with open(path, 'r') as config:
+                template_data = config.read()
+            if self.update_haproxy_runtime(previous_data, template_data):
+                return True
+        return self.request_reload()
+
+    def validate_config(self, path):
+        """
+        Run validate_cmd (ie. haproxy -c -f) on a configuration file.
+        Return True when it succeeds or when there is no validation command.
+        """
+        if not self.options.get('validate_cmd'):
+            return True
+        command = shlex.split(self.options['validate_cmd']) + [path]
+        try:
+            code = call(command)
+        except OSError as e:
+            self.log.error("Cannot run the validation command %s : %s", ' '.join(command), e)
+            return False
+        if code != 0:
+            self.log.error("The new HAproxy configuration is invalid (%s returned %d). Keeping the current one", ' '.join(command), code)
+            return False
+        return True
+
+    def install_config(self, tmp_path, path, digest):
+        """
+        Atomically replace path by tmp_path, keeping the owner and mode of
+        path. A symlink is kept and its target replaced.
+        """
+        target = os.path.realpath(path)
+        try:
+            try:
+                stat = os.stat(target)
+            except OSError:
+                os.chmod(tmp_path, 0o644)
+            else:
+                try:
+                    os.chown(tmp_path, stat.st_uid, stat.st_gid)
+                except OSError as e:
+                    self.log.debug("Cannot keep the owner of %s : %s", target, e)
+                os.chmod(tmp_path, stat.st_mode & 0o7777)
+            os.replace(tmp_path, target)
+        except Exception as e:
+            self.log.error("Error while manipulating %s :\n%s", path, e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return False
+        self.digests[path] = digest
+        return True
 
-    def do_we_have_changes(self, template_data):
-        file_md5 = hashlib.md5()
+    def write_config(self, path, data):
         try:
-            with open(self.options['haproxy_cfg'], 'r') as config:
-                file_md5.update(config.read().encode())
-                config.close()
+            tmp_path, digest, _ = stream_to_temp(path, [data])
         except Exception as e:
-            self.log.error("Error accessing HAproxy configuration : %s", e)
+            self.log.error("Error while manipulating %s :\n%s", path, e)
             return False
+        return self.install_config(tmp_path, path, digest)
+
+    def build_outputs(self, instances, hostname, cpu_count, cpu_reserved, context=None):
+        """
+        Render and write the extra outputs. Return False on error.
+        outputs_need_reload tells if one of the changes needs a reload.
+        """
+        self.outputs_need_reload = False
+        for output in self.outputs:
+            if output.format == 'json':
+                data = render_json(instances, context)
+            else:
+                try:
+                    template = self.get_template(output.template)
+                    with render_scope():
+                        data = template.render(context or {}, instances=instances, hostname=hostname, cpu_count=cpu_count, cpu_reserved=cpu_reserved)
+                except Exception as e:
+                    self.log.error("Cannot render the output %s : %s", output.path, e)
+                    return False
+
+            if self.options['dry_run']:
+                self.log.info("Dry run. Output %s :\n%s", output.path, data)
+                continue
+
+            if not self.do_we_have_changes(data, output.path):
+                continue
+
+            previous_data = None
+            if output.map and not self.governor.pending:
+                try:
+                    with open(output.path, 'r') as handle:
+                        previous_data = handle.read()
+                except Exception as e:
+                    self.log.debug("Cannot read the previous map %s : %s", output.path, e)
+
+            self.log.debug('Writing output : %s', output.path)
+            if not self.write_config(output.path, data):
+                return False
 
-        data_md5 = hashlib.md5()
-        data_md5.update(template_data.encode())
+            if previous_data is not None and self.update_haproxy_map(output.path, previous_data, data):
+                continue
+            if output.reload or output.map:
+                self.outputs_need_reload = True
+        return True
 
-        return data_md5.hexdigest() == file_md5.hexdigest()
+    def get_haproxy_sockets(self, config_data=None):
+        if self.options.get('haproxy_sockets'):
+            return self.options['haproxy_sockets'].split(',')
+        if config_data is None:
+            try:
+                with open(self.options['haproxy_cfg'], 'r') as config:
+                    config_data = config.read()
+            except Exception as e:
+                self.log.debug("Cannot read HAproxy configuration : %s", e)
+                return []
+        return find_stats_sockets(config_data)
+
+    def update_haproxy_map(self, path, previous_data, map_data):
+        """
+        Apply the changes of a map file through the HAproxy Runtime API.
+        Return False when a reload is needed instead.
+        """
+        sockets = self.get_haproxy_sockets()
+        if not sockets:
+            self.log.error("No admin stats socket found. Will reload HAproxy service for map %s", path)
+            return False
+
+        commands = plan_map_commands(path, previous_data, map_data)
+        try:
+            RuntimeAPI(sockets, self.options.get('runtime_timeout') or 2).apply(commands)
+        except RuntimeAPIError as e:
+            self.log.error("Runtime API update of map %s failed. Will reload HAproxy service : %s", path, e)
+            return False
+
+        self.metrics.inc('havoc_runtime_updates_total')
+        self.log.info("Map %s updated through the Runtime API (%d commands on %d sockets)", path, len(commands), len(sockets))
+        return True
+
+    def request_reload(self):
+        """
+        Reload HAproxy now or leave it pending if the governor throttles it
+        """
+        allowed = self.governor.request()
+        self.metrics.set('havoc_reloads_suppressed_total', self.governor.suppressed)
+        self.metrics.set('havoc_reloads_coalesced_total', self.governor.coalesced)
+        if not allowed:
+            self.log.info("HAproxy reload deferred for %.1f sec (%d suppressed, %d coalesced)",
+                          self.governor.wait_time(), self.governor.suppressed, self.governor.coalesced)
+            return True
+        return self.do_reload()
+
+    def flush_reload(self):
+        """
+        Run the pending reload when the governor allows it
+        """
+        if not self.governor.due():
+            return True
+        self.log.info("Running deferred HAproxy reload")
+        return self.do_reload()
+
+    def do_reload(self):
+        # The configuration is already in place, a failed reload is retried
+        # until HAproxy runs it
+        if not self.reload_haproxy():
+            self.governor.failed()
+            return False
+        self.governor.reloaded()
+        self.metrics.inc('havoc_reloads_total')
+        return True
+
+    def update_haproxy_runtime(self, previous_data, template_data):
+        """
+        Apply membership-only changes through the HAproxy Runtime API.
+        Return False when a reload is needed instead.
+        """
+        commands = plan_runtime_commands(previous_data, template_data)
+        if commands is None:
+            self.log.info("HAproxy configuration structure changed. A reload is needed")
+            return False
+
+        sockets = self.get_haproxy_sockets(template_data)
+        if not sockets:
+            self.log.error("No admin stats socket found. Will reload HAproxy service")
+            return False
+
+        try:
+            RuntimeAPI(sockets, self.options.get('runtime_timeout') or 2).apply(commands)
+        except RuntimeAPIError as e:
+            self.log.error("Runtime API update failed. Will reload HAproxy service : %s", e)
+            return False
+
+        self.metrics.inc('havoc_runtime_updates_total')
+        for command in commands:
+            self.log.debug("Runtime API : %s", command)
+        self.log.info("HAproxy updated through the Runtime API (%d commands on %d sockets)", len(commands), len(sockets))
+        return True
+
+    def do_we_have_changes(self, template_data, path=None):
+        """
+        Return True when template_data differs from the file at path (the
+        HAproxy configuration by default). The file is only hashed when
+        nothing has been written to it yet.
+        """
+        return self.digest_changed(hashlib.md5(template_data.encode()).hexdigest(), path)
+
+    def digest_changed(self, digest, path=None):
+        """
+        Return True when digest differs from the md5 of the file at path (the
+        HAproxy configuration by default)
+        """
+        path = path or self.options['haproxy_cfg']
+        if path not in self.digests:
+            try:
+                self.digests[path] = file_digest(path)
+            except Exception as e:
+                self.log.debug("Error accessing %s : %s", path, e)
+                return True
+        return digest != self.digests[path]
 
     def reload_haproxy(self):
         try:
@@ -150,26 +606,398 @@ class Havoc(object):
             service = ["service", "haproxy", "reload"]
 
         try:
-            call(service)
+            code = call(service)
         except Exception as e:
             self.log.error("Failed to reload HAproxy service : %s", e)
             return False
+        if code != 0:
+            self.log.error("Failed to reload HAproxy service : %s returned %d", ' '.join(service), code)
+            return False
+        return True
+
+    def discover(self, pools, deadline=None):
+        """
+        Retrieve the instances of every pool from every provider.
+        Lookups are run concurrently when discovery_workers is greater than 1
+        or when a provider latency budget is set. The pools of a failing or
+        slow provider are served from the inventory snapshot and marked stale,
+        or listed in unavailable_pools when the snapshot cannot serve them.
+        """
+        self.log.debug("POOLS : %s", ','.join(pools))
+        self.discovery_errors = 0
+        self.stale_pools = {}
+        self.unavailable_pools = set()
+        if deadline is None and self.options.get('discovery_deadline'):
+            deadline = time.time() + self.options['discovery_deadline']
+        self.cycle_deadline = deadline
+        lookups = self.get_lookups(pools)
+
+        workers = self.options.get('discovery_workers') or 0
+        if len(self.ec2_accounts) > 1 or (self.options.get('provider_budget') and self.snapshot is not None):
+            workers = max(workers, len(lookups))
+        if workers > 1 and len(lookups) > 1:
+            results = self._run_lookups_concurrently(lookups, workers)
+        else:
+            results = []
+            for lookup in lookups:
+                try:
+                    results.append(lookup.func(*lookup.args))
+                except Exception as e:
+                    self.log.error("Error listing instances for %s : %s", lookup.label, e)
+                    self.discovery_errors += 1
+                    results.append(None)
+
+        instances = dict((pool, []) for pool in pools)
+        counts = dict((pool, {}) for pool in pools)
+        for (provider, _, _, _, _), found in zip(lookups, results):
+            if found is None:
+                found = self.get_snapshot_instances(provider, pools)
+                self.unavailable_pools.update(pool for pool in pools if pool not in found)
+            elif self.snapshot is not None:
+                self.snapshot.update(provider, found)
+            for pool in pools:
+                if pool not in found:
+                    continue
+                instances[pool].extend(found[pool])
+                counts[pool][provider] = len(found[pool])
+        for pool in pools:
+            if pool not in self.unavailable_pools:
+                self.backend_counts[pool] = counts[pool]
+        if self.leader is not None:
+            for pool, age in self.leader.stale.items():
+                if pool in instances:
+                    self.stale_pools[pool] = max(age, self.stale_pools.get(pool, 0))
+        self.metrics.set('havoc_stale_pools', len(self.stale_pools))
+
+        if self.snapshot is not None:
+            self.snapshot.save()
+        return instances
 
-    def run(self):
+    def get_lookups(self, pools):
+        """
+        Return the provider lookups of a discovery cycle
+        """
+        if self.leader is not None:
+            return [Lookup('leader', 'Leader', self._measure_lookup('leader', self.leader.list_instances), (pools,), None)]
+
+        #TODO: Create CLI parameters for suffixes
+        lookups = []
+        for account in self.ec2_accounts:
+            lookups.append(Lookup(account.provider, account.label,
+                                  self._measure_lookup(account.provider, self.list_ec2_instances_by_pool),
+                                  (pools, "_aws", account), account.timeout))
+        lookups.append(Lookup('openstack', 'Openstack',
+                              self._measure_lookup('openstack', self.get_os_instances_by_pool),
+                              (pools, "_os"), None))
+        if self.static is not None:
+            lookups.append(Lookup('static', 'Static',
+                                  self._measure_lookup('static', self.static.list_instances),
+                                  (pools, None, self.backend_tags), None))
+        return lookups
+
+    def _measure_lookup(self, provider, lookup):
+        """
+        Wrap a provider lookup to record its latency and errors
+        """
+        if not self.metrics.enabled:
+            return lookup
+
+        def measured(*args):
+            try:
+                with self.metrics.timer('havoc_discovery_seconds', provider=provider):
+                    return lookup(*args)
+            except Exception:
+                self.metrics.inc('havoc_api_errors_total', provider=provider)
+                raise
+        return measured
+
+    def get_snapshot_instances(self, provider, pools):
+        """
+        Return the instances of provider from the snapshot, marking their
+        pools stale. Pools older than snapshot_max_age are left out.
+        """
+        if self.snapshot is None:
+            return {}
+
+        found = self.snapshot.get(provider, pools, self.options.get('snapshot_max_age'))
         instances = {}
+        for pool in pools:
+            if pool not in found:
+                self.log.error("No usable %s snapshot for pool %s", provider, pool)
+                continue
+            age, backends = found[pool]
+            self.log.warning("Serving pool %s from the %s snapshot (%d sec old)", pool, provider, age)
+            self.stale_pools[pool] = max(age, self.stale_pools.get(pool, 0))
+            instances[pool] = backends
+        return instances
 
-        # Retrieve instances
+    def _run_lookups_concurrently(self, lookups, workers):
+        default_timeout = self.options.get('discovery_timeout') or None
+        budget = self.options.get('provider_budget') if self.snapshot is not None else None
+        started = {}
+        watch = default_timeout or budget or any(lookup.timeout for lookup in lookups)
+
+        def timed(idx, lookup, args):
+            started[idx] = time.time()
+            return lookup(*args)
+
+        results = [None for _ in lookups]
+        executor = ThreadPoolExecutor(max_workers=min(workers, len(lookups)))
+        try:
+            futures = {}
+            for idx, lookup in enumerate(lookups):
+                if lookup.provider in self.refreshing:
+                    self.log.info("%s is still being refreshed in background", lookup.label)
+                    continue
+                futures[executor.submit(timed, idx, lookup.func, lookup.args)] = idx
+
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.1 if watch else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx = futures[future]
+                    try:
+                        results[idx] = future.result()
+                    except Exception as e:
+                        self.log.error("Error listing instances for %s : %s", lookups[idx].label, e)
+                        self.discovery_errors += 1
+                now = time.time()
+                for future in list(pending):
+                    idx = futures[future]
+                    if idx not in started:
+                        continue
+                    provider, label = lookups[idx].provider, lookups[idx].label
+                    timeout = lookups[idx].timeout or default_timeout
+                    if timeout and now - started[idx] > timeout:
+                        self.log.error("Timeout after %ss while looking up %s", timeout, label)
+                        self.discovery_errors += 1
+                        self.metrics.inc('havoc_api_errors_total', provider=provider)
+                        pending.discard(future)
+                    elif budget and now - started[idx] > budget:
+                        self.log.warning("%s is over its latency budget of %ss. Refreshing in background", label, budget)
+                        self.refreshing.add(provider)
+                        future.add_done_callback(partial(self._refreshed_in_background, provider, label))
+                        pending.discard(future)
+            return results
+        finally:
+            # Do not wait on lookups that timed out
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _refreshed_in_background(self, provider, label, future):
+        self.refreshing.discard(provider)
+        try:
+            found = future.result()
+        except Exception as e:
+            self.log.error("Background refresh of %s failed : %s", label, e)
+            return
+        self.snapshot.update(provider, found)
+        self.snapshot.save()
+        self.log.info("%s refreshed in background", label)
+
+    def detect_changes(self, instances, templates, context=None):
+        """
+        Compare the inventory and the template with the last generated
+        configuration. Return None when none of them changed, the new state
+        otherwise. The per pool added/removed/changed members are kept in
+        last_delta.
+        """
+        index = inventory_index(instances)
+        current = fingerprint(index, context)
+        try:
+            stamp = tuple(template_stamp(template) for template in templates)
+        except OSError:
+            stamp = None
+
+        if stamp is not None and current == self.last_fingerprint and stamp == self.last_template_stamp:
+            self.last_delta = {}
+            return None
+
+        self.last_delta = diff_inventory(self.last_index or {}, index)
+        for pool, changes in self.last_delta.items():
+            self.log.info("Pool %s : %d added, %d removed, %d changed", pool, len(changes['added']), len(changes['removed']), len(changes['changed']))
+            self.log.debug("Pool %s changes : %s", pool, changes)
+        return index, current, stamp
+
+    def get_pool_settings(self):
+        """
+        Return {pool: (refresh interval in seconds, priority)} from the
+        pool_settings of the configuration. Pools without settings are
+        refreshed every interval with priority 0.
+        """
+        default = time_str_to_sec(self.options.get('interval') or '5min')
+        configured = parse_pool_settings(self.options.get('pool_settings'))
+        settings = {}
         for pool in self.options['pools'].split(','):
-            self.log.debug("POOL : %s", pool)
-            #TODO: Create CLI parameters for suffixes
-            ec2_instances = self.get_ec2_instances_in_pool(pool, "_aws")
-            os_instances = self.get_os_instances_in_pool(pool, "_os")
-            instances[pool] = ec2_instances + os_instances
+            interval, priority = configured.get(pool, (None, 0))
+            settings[pool] = (interval or default, priority)
+        return settings
+
+    def refresh(self, pools, now=None):
+        """
+        Discover the pools due for a refresh and reuse the cached instances
+        of the other pools. The due pools are discovered in a single sweep,
+        or with a discovery_deadline one sweep per priority, highest first,
+        so that the pools left when the deadline is reached are the lowest
+        priority ones. They keep their cached instances. Pools a provider
+        failed for keep their previous instances. Return None when such a
+        pool has never been discovered.
+        """
+        now = now if now is not None else time.time()
+        settings = self.get_pool_settings()
+        # A pool is due slightly before its interval so that cycle drift does
+        # not postpone it by a whole cycle
+        due = [pool for pool in pools
+               if pool not in self.pool_refreshed or now - self.pool_refreshed[pool] >= settings[pool][0] * 0.95]
+        if len(due) < len(pools):
+            self.log.debug("Refreshing pools %s, reusing %s", ','.join(due), ','.join(p for p in pools if p not in due))
+
+        deadline = None
+        groups = [due] if due else []
+        if due and self.options.get('discovery_deadline'):
+            deadline = time.time() + self.options['discovery_deadline']
+            groups = [[pool for pool in due if settings[pool][1] == priority]
+                      for priority in sorted(set(settings[pool][1] for pool in due), reverse=True)]
+
+        found = {}
+        errors = 0
+        stale = {}
+        unavailable = set()
+        deferred = set()
+        for group in groups:
+            # Pools never discovered are looked up anyway, the snapshot
+            # serving them when the providers are past the deadline
+            if deadline is not None and time.time() >= deadline and all(pool in self.pool_cache for pool in group):
+                self.log.warning("Discovery deadline reached. Pools %s keep their cached instances", ','.join(group))
+                deferred.update(group)
+                continue
+            found.update(self.discover(group, deadline))
+            errors += self.discovery_errors
+            stale.update(self.stale_pools)
+            unavailable.update(self.unavailable_pools)
+        self.discovery_errors = errors
+        self.stale_pools = stale
+        self.unavailable_pools = unavailable | deferred
+
+        instances = {}
+        for pool in sorted(pools, key=lambda pool: -settings[pool][1]):
+            if pool in found and pool not in self.unavailable_pools:
+                self.pool_cache[pool] = found[pool]
+                # Stale pools are retried on the next cycle
+                if pool not in self.stale_pools:
+                    self.pool_refreshed[pool] = now
+            elif pool in self.unavailable_pools:
+                if pool not in self.pool_cache:
+                    self.log.error("Pool %s has never been discovered and its provider failed. Not rendering", pool)
+                    return None
+                age = now - self.pool_refreshed[pool] if pool in self.pool_refreshed else 0
+                self.log.warning("Keeping the previous instances of pool %s (%d sec old)", pool, age)
+                self.stale_pools[pool] = max(age, self.stale_pools.get(pool, 0))
+            instances[pool] = self.pool_cache.get(pool, [])
+        self.metrics.set('havoc_stale_pools', len(self.stale_pools))
+        # Pools and providers which are gone lose their series
+        self.metrics.replace('havoc_backends', [(count, {'pool': pool, 'provider': provider})
+                                                for pool in pools
+                                                for provider, count in self.backend_counts.get(pool, {}).items()])
+        return instances
+
+    def run(self):
+        started = time.time()
+        # Retrieve instances
+        instances = self.refresh(self.options['pools'].split(','))
+        if instances is None:
+            self.metrics.inc('havoc_cycles_total', result='failure')
+            return 1
+        self.last_instances = instances
+        if self.publisher is not None and self.publisher.publish(instances, self.stale_pools):
+            self.log.info("Publishing inventory version %d", self.publisher.version)
+        if self.preflight is not None:
+            instances = self.check_backends(instances)
+            self.last_instances = instances
+        result = self.generate(instances)
+
+        self.metrics.observe('havoc_cycle_seconds', time.time() - started)
+        self.metrics.inc('havoc_cycles_total', result='success' if result == 0 else 'failure')
+        try:
+            self.metrics.flush()
+        except (IOError, OSError) as e:
+            self.log.error("Cannot write metrics textfile : %s", e)
+        return result
+
+    def check_backends(self, instances):
+        """
+        Probe the new backends. The ones not ready yet are left out of the
+        instances, or only marked in the ready template variable with
+        preflight_mark.
+        """
+        self.ready = self.preflight.check(instances)
+        pending = sum(1 for pool in self.ready.values() for ready in pool.values() if not ready)
+        self.metrics.set('havoc_preflight_pending', pending)
+        if pending:
+            self.log.info("Pre-flight : %d backends are not ready yet", pending)
+        if self.options.get('preflight_mark'):
+            return instances
+        return dict((pool, [backend for backend in members if self.ready[pool][backend.name]])
+                    for pool, members in instances.items())
+
+    def warm_start(self):
+        """
+        Generate the configuration from the inventory snapshot, before the
+        providers are queried for the first time
+        """
+        if self.snapshot is None or self.last_instances is not None:
+            return 1
+        pools = self.options['pools'].split(',')
+        self.stale_pools = {}
+        instances = dict((pool, []) for pool in pools)
+        for lookup in self.get_lookups(pools):
+            found = self.get_snapshot_instances(lookup.provider, pools)
+            missing = [pool for pool in pools if pool not in found]
+            if missing:
+                self.log.info("No warm start, the snapshot misses pools %s", ','.join(missing))
+                return 1
+            for pool, backends in found.items():
+                instances[pool].extend(backends)
+        self.log.info("Warm start from the inventory snapshot %s", self.snapshot.path)
+        self.last_instances = instances
+        return self.generate(instances)
+
+    def render(self):
+        """
+        Generate the configuration from the last discovered instances,
+        without querying the providers
+        """
+        if self.last_instances is None:
+            return self.run()
+        return self.generate(self.last_instances)
+
+    def template_context(self, instances):
+        """
+        Extra variables given to the template
+        """
+        return {
+            'stale': dict((pool, pool in self.stale_pools) for pool in instances),
+            'refreshed': dict((pool, self.pool_refreshed.get(pool)) for pool in instances),
+            'ready': self.ready,
+            'slots': self.slot_allocator.allocate(instances),
+        }
+
+    def generate(self, instances):
+        context = self.template_context(instances)
+        templates = [self.options['template']] + [output.template for output in self.outputs if output.template]
+        # Refresh timestamps alone do not make a new configuration
+        state = self.detect_changes(instances, templates, dict((k, v) for k, v in context.items() if k != 'refreshed'))
+        if state is None:
+            self.log.debug('No changes in instances and template. Skipping HAproxy configuration.')
+            self.metrics.inc('havoc_changes_total', result='skipped')
+            return 0 if self.flush_reload() else 1
+
+        if not self.build_outputs(instances, self.options['log_send_hostname'], self.options['cpus'], self.options['system_cpus'], context):
+            return 1
 
         # Building HAproxy configuratio based on Jinja2 template
-        if self.build_haproxy_conf(self.options['template'], instances, self.options['log_send_hostname'], self.options['cpus'], self.options['system_cpus']):
+        if self.build_haproxy_conf(self.options['template'], instances, self.options['log_send_hostname'], self.options['cpus'], self.options['system_cpus'], context):
+            self.last_index, self.last_fingerprint, self.last_template_stamp = state
             self.log.info('HAproxy configuration has been generated.')
             return 0
 
         return 1
-
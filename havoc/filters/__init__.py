@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HAvOC - Jinja2 filters
+
+Every module of this package exposes its filters in a FILTERS dict
+({filter name: function}). They are discovered and registered on the
+HAvOC Jinja2 environment.
+"""
+
+import importlib
+import pkgutil
+import threading
+from contextlib import contextmanager
+
+# Indexes built by the filters during the current render of every thread
+_renders = threading.local()
+
+
+def discover_filters():
+    """
+    Return the filters of every module of the havoc.filters package
+    """
+    filters = {}
+    for _, name, _ in pkgutil.iter_modules(__path__):
+        module = importlib.import_module('%s.%s' % (__name__, name))
+        filters.update(getattr(module, 'FILTERS', {}))
+    return filters
+
+
+def memoize(value, key, build):
+    """
+    Return the result of build() computed once per render for value and key.
+    The result is kept with value itself, so a reused id() never matches.
+    Nothing is kept outside of render_scope().
+    """
+    memo = getattr(_renders, 'memo', None)
+    if memo is None:
+        return build()
+    memo_key = (id(value), key)
+    cached = memo.get(memo_key)
+    if cached is not None and cached[0] is value:
+        return cached[1]
+    result = build()
+    memo[memo_key] = (value, result)
+    return result
+
+
+@contextmanager
+def render_scope():
+    """
+    Keep the indexes built by the filters for the duration of a render only
+    """
+    _renders.memo = {}
+    try:
+        yield
+    finally:
+        _renders.memo = None
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HAvOC - Jinja2 indexing filters
+
+Build per-render indexes of a pool so a template can slice it several ways
+with dictionary lookups:
+
+    {% set zones = instances['appa']|group_by('zone') %}
+    {% for i in zones['us-east-1a'] %}...{% endfor %}
+"""
+
+from havoc.filters import memoize
+
+
+def _group(value, get):
+    groups = {}
+    for v in value:
+        groups.setdefault(get(v), []).append(v)
+    return groups
+
+
+def filter_group_by(value, attribute):
+    """
+    Return {attribute value: [items]}
+    """
+    return memoize(value, ('group_by', attribute),
+                   lambda: _group(value, lambda v: getattr(v, attribute, None)))
+
+
+def filter_partition_by_tag(value, tag):
+    """
+    Return {tag value: [items]}. Items without the tag are grouped under None.
+    """
+    return memoize(value, ('partition_by_tag', tag),
+                   lambda: _group(value, lambda v: (getattr(v, 'tags', None) or {}).get(tag)))
+
+
+def filter_index_by(value, attribute):
+    """
+    Return {attribute value: item}, the last item winning on duplicates
+    """
+    return memoize(value, ('index_by', attribute),
+                   lambda: dict((getattr(v, attribute, None), v) for v in value))
+
+
+FILTERS = {
+    'group_by': filter_group_by,
+    'partition_by_tag': filter_partition_by_tag,
+    'index_by': filter_index_by,
+}
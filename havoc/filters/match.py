@@ -6,13 +6,20 @@ HAvOC - Jinja2 filters
 """
 
 import re
+from functools import lru_cache
+
+from havoc.filters import memoize
+
+
+@lru_cache(maxsize=256)
+def _compile(pattern, flags):
+    return re.compile(pattern, flags)
+
 
 def filter_match_dict(value, pattern, key, ignorecase=False):
     """
-    Return first pattern match of value
+    Return the items of value whose key attribute matches pattern
     """
-    matches = []
-
     if key is None or pattern is None:
         return value
 
@@ -21,9 +28,18 @@ def filter_match_dict(value, pattern, key, ignorecase=False):
     else:
         flags = 0
 
-    _re = re.compile(pattern)
-    for v in value:
-        if _re.match(v.__getattribute__(key)):
-            matches.append(v)
+    def build():
+        _re = _compile(pattern, flags)
+        matches = []
+        for v in value:
+            attribute = getattr(v, key, None)
+            if attribute is not None and _re.match(attribute):
+                matches.append(v)
+        return matches
+
+    return memoize(value, ('match', pattern, key, flags), build)
+
 
-    return matches
+FILTERS = {
+    'match': filter_match_dict,
+}
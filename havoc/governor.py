@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - HAproxy reload governor
+
+Throttle reloads during autoscaling churn: reloads are spaced by a minimum
+interval, capped per time window, and the changes arriving in between are
+coalesced into a single pending reload.
+"""
+
+import time
+from collections import deque
+
+
+class ReloadGovernor(object):
+
+    def __init__(self, min_interval=0, max_reloads=0, window=3600, clock=time.time):
+        self.min_interval = min_interval
+        self.max_reloads = max_reloads
+        self.window = window
+        self.clock = clock
+        self.history = deque()
+        self.pending = False
+        # Counters
+        self.reloads = 0
+        self.suppressed = 0
+        self.coalesced = 0
+
+    def wait_time(self):
+        """
+        Return the number of seconds before a reload is allowed
+        """
+        now = self.clock()
+        while self.history and now - self.history[0] >= self.window:
+            self.history.popleft()
+
+        wait = 0
+        if self.history and self.min_interval:
+            wait = max(wait, self.history[-1] + self.min_interval - now)
+        if self.max_reloads and len(self.history) >= self.max_reloads:
+            wait = max(wait, self.history[0] + self.window - now)
+        return wait
+
+    def request(self):
+        """
+        Ask for a reload. Return True when it can happen now, otherwise the
+        reload stays pending and is merged with the next requests.
+        """
+        if self.wait_time() <= 0:
+            return True
+        if self.pending:
+            self.coalesced += 1
+        self.suppressed += 1
+        self.pending = True
+        return False
+
+    def due(self):
+        """
+        Return True when a pending reload can happen now
+        """
+        return self.pending and self.wait_time() <= 0
+
+    def reloaded(self):
+        """
+        Record a reload. Any pending reload is done with it.
+        """
+        self.history.append(self.clock())
+        self.reloads += 1
+        self.pending = False
+
+    def failed(self):
+        """
+        Record a failed reload. It stays pending and is retried.
+        """
+        self.pending = True
+
+    def stats(self):
+        return {
+            'reloads': self.reloads,
+            'suppressed': self.suppressed,
+            'coalesced': self.coalesced,
+            'pending': self.pending,
+        }
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Inventory fingerprint and delta between two discovery cycles
+"""
+
+import hashlib
+import json
+
+
+def inventory_index(instances):
+    """
+    Normalize the instances of every pool into {pool: {name: [ip]}}. Members
+    sharing a name are all kept, their IPs sorted.
+    """
+    index = {}
+    for pool, members in instances.items():
+        names = {}
+        for i in members:
+            names.setdefault(i.name, []).append(getattr(i, 'ip_address', None) or '')
+        index[pool] = dict((name, sorted(ips)) for name, ips in names.items())
+    return index
+
+
+def fingerprint(index, context=None):
+    """
+    Return a stable hash of an inventory index and of the extra template
+    variables
+    """
+    digest = hashlib.sha1()
+    if context:
+        digest.update(json.dumps(context, sort_keys=True, default=str).encode())
+    for pool in sorted(index):
+        digest.update(('pool %s\n' % pool).encode())
+        for name in sorted(index[pool]):
+            for ip in index[pool][name]:
+                digest.update(('%s %s\n' % (name, ip)).encode())
+    return digest.hexdigest()
+
+
+def diff_inventory(old_index, new_index):
+    """
+    Return the members added, removed and changed (new IPs) in every pool.
+    Pools without any change are not part of the result.
+    """
+    delta = {}
+    for pool in sorted(set(old_index) | set(new_index)):
+        old = old_index.get(pool, {})
+        new = new_index.get(pool, {})
+        changes = {
+            'added': sorted(name for name in new if name not in old),
+            'removed': sorted(name for name in old if name not in new),
+            'changed': sorted(name for name in new if name in old and new[name] != old[name]),
+        }
+        if changes['added'] or changes['removed'] or changes['changed']:
+            delta[pool] = changes
+    return delta
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Metrics
+
+Counters, gauges and histograms exposed in the Prometheus text format,
+through a local HTTP listener or a node-exporter textfile. When metrics are
+disabled, NullMetrics turns every hook into a no-op.
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name: (type, help)
+METRICS = {
+    'havoc_discovery_seconds': ('histogram', 'Duration of the provider lookups'),
+    'havoc_api_errors_total': ('counter', 'Failed or timed out provider lookups'),
+    'havoc_api_throttled_total': ('counter', 'Provider requests throttled and retried'),
+    'havoc_backends': ('gauge', 'Number of backends per pool and provider'),
+    'havoc_stale_pools': ('gauge', 'Number of pools served from the inventory snapshot'),
+    'havoc_preflight_pending': ('gauge', 'Number of new backends failing their pre-flight check'),
+    'havoc_render_seconds': ('histogram', 'Duration of the template rendering'),
+    'havoc_config_bytes': ('gauge', 'Size of the rendered HAproxy configuration'),
+    'havoc_changes_total': ('counter', 'Result of the change detection'),
+    'havoc_reloads_total': ('counter', 'HAproxy reloads'),
+    'havoc_reloads_suppressed_total': ('counter', 'HAproxy reloads deferred by the reload governor'),
+    'havoc_reloads_coalesced_total': ('counter', 'HAproxy reloads merged into a pending reload'),
+    'havoc_runtime_updates_total': ('counter', 'Updates applied through the HAproxy Runtime API'),
+    'havoc_cycle_seconds': ('histogram', 'Duration of the HAvOC cycles'),
+    'havoc_cycles_total': ('counter', 'HAvOC cycles'),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.time() - self.started, **self.labels)
+        return False
+
+
+class NullMetrics(object):
+    """
+    Disabled metrics
+    """
+    enabled = False
+    _timer = _NullTimer()
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def set(self, name, value, **labels):
+        pass
+
+    def replace(self, name, series):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return self._timer
+
+    def flush(self):
+        pass
+
+
+class Metrics(object):
+
+    enabled = True
+
+    def __init__(self, textfile=None):
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def replace(self, name, series):
+        """
+        Replace every series of a gauge by series ([(value, labels)])
+        """
+        with self.lock:
+            for key in [key for key in self.values if key[0] == name]:
+                del self.values[key]
+            for value, labels in series:
+                self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0, 0.0]
+            for idx, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][idx] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text format
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described and name in METRICS:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, METRICS[name][1]))
+                lines.append('# TYPE %s %s' % (name, METRICS[name][0]))
+
+        for (name, labels), value in values:
+            describe(name)
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), (buckets, count, total) in histograms:
+            describe(name)
+            for bound, hits in zip(BUCKETS, buckets):
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', bound),)), hits))
+            lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', '+Inf'),)), count))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), total))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """
+        Write the node-exporter textfile, when one is configured
+        """
+        if self.textfile is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.textfile))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.havoc-metrics-')
+        with os.fdopen(fd, 'w') as handle:
+            handle.write(self.render())
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, self.textfile)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(metrics, port, address='127.0.0.1'):
+    """
+    Serve the metrics on http://address:port/metrics from a daemon thread
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer((address, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='havoc-metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def build_metrics(options):
+    if options.get('metrics_port') or options.get('metrics_textfile'):
+        return Metrics(options.get('metrics_textfile'))
+    return NullMetrics()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Additional outputs
+
+Besides haproxy.cfg, every cycle can render extra files from the same
+inventory: HAproxy map and ACL files, or a JSON dump for other tooling.
+Each output has its own change detection and declares whether a change in
+it needs a HAproxy reload.
+"""
+
+import json
+
+
+class Output(object):
+    """
+    An extra file rendered every cycle.
+
+    format is 'template' (render template) or 'json' (dump the inventory).
+    A map output is pushed to HAproxy through the Runtime API when it changes.
+    """
+
+    def __init__(self, path, template=None, reload=True, map=False, format='template'):
+        if format not in ('template', 'json'):
+            raise ValueError("Unknown output format : %s" % format)
+        if format == 'template' and not template:
+            raise ValueError("Output %s needs a template" % path)
+        self.path = path
+        self.template = template
+        self.reload = reload
+        self.map = map
+        self.format = format
+
+    def __repr__(self):
+        return '<Output %s %s reload=%s map=%s>' % (self.path, self.template or self.format, self.reload, self.map)
+
+
+def parse_output(spec):
+    """
+    Parse an output given on the command line :
+        TEMPLATE:PATH[:noreload|:map]  or  json:PATH
+    Map outputs and JSON dumps do not need a reload.
+    """
+    parts = spec.split(':')
+    if len(parts) < 2:
+        raise ValueError("Invalid output '%s', expected TEMPLATE:PATH[:noreload|:map]" % spec)
+    flags = parts[2:]
+    for flag in flags:
+        if flag not in ('noreload', 'map'):
+            raise ValueError("Invalid output flag '%s' in '%s'" % (flag, spec))
+    is_map = 'map' in flags
+    reload = 'noreload' not in flags and not is_map
+    if parts[0] == 'json':
+        return Output(parts[1], reload=False, format='json')
+    return Output(parts[1], template=parts[0], reload=reload, map=is_map)
+
+
+def load_outputs(specs=None, entries=None):
+    """
+    Build the outputs from command line specs and configuration entries
+    (list of dicts with path, template, reload, map and format keys)
+    """
+    outputs = [parse_output(spec) for spec in specs or []]
+    for entry in entries or []:
+        is_map = entry.get('map', False)
+        output_format = entry.get('format', 'template')
+        outputs.append(Output(entry['path'], template=entry.get('template'),
+                              reload=entry.get('reload', not is_map and output_format != 'json'),
+                              map=is_map, format=output_format))
+    return outputs
+
+
+def render_json(instances, context=None):
+    """
+    Dump the inventory as JSON
+    """
+    data = {
+        'pools': dict((pool, [{'name': i.name, 'ip': i.ip_address, 'port': getattr(i, 'port', None),
+                               'provider': getattr(i, 'provider', None), 'region': getattr(i, 'region', None),
+                               'zone': getattr(i, 'zone', None),
+                               'tags': getattr(i, 'tags', None)}
+                              for i in sorted(members, key=lambda m: m.name)])
+                      for pool, members in instances.items()),
+    }
+    data.update(context or {})
+    return json.dumps(data, indent=2, sort_keys=True, default=str) + '\n'
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Backend pre-flight checks
+
+New backends are probed concurrently (TCP connect or HTTP HEAD) before they
+reach the configuration. Backends which answered are remembered and not
+probed again while they stay in the inventory. When every new backend fails
+its probe, a few healthy backends are probed again: when they fail too, the
+checks are broken rather than the backends, and they are skipped.
+"""
+
+import asyncio
+
+# Number of healthy backends probed again when every new backend failed
+HEALTHY_SAMPLE = 3
+
+
+class Preflight(object):
+
+    def __init__(self, mode='tcp', port=80, path='/', timeout=2, concurrency=100, log=None):
+        self.mode = mode
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.log = log
+        # (name, ip, port) of the backends which answered
+        self.healthy = set()
+
+    def key(self, backend):
+        return (backend.name, backend.ip_address, getattr(backend, 'port', None) or self.port)
+
+    async def probe(self, semaphore, ip, port):
+        """
+        Return True when ip:port accepts connections, and answers a HEAD
+        request with a 2xx or 3xx status in http mode
+        """
+        if ip is None:
+            return False
+        async with semaphore:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                return False
+            try:
+                if self.mode != 'http':
+                    return True
+                writer.write(('HEAD %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (self.path, ip)).encode())
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                status = (await asyncio.wait_for(reader.readline(), self.timeout)).split()
+                return len(status) >= 2 and status[1][:1] in (b'2', b'3')
+            except (OSError, asyncio.TimeoutError):
+                return False
+            finally:
+                writer.close()
+                try:
+                    await asyncio.wait_for(writer.wait_closed(), self.timeout)
+                except (OSError, asyncio.TimeoutError):
+                    pass
+
+    async def probe_all(self, targets):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return await asyncio.gather(*[self.probe(semaphore, ip, port) for ip, port in targets])
+
+    def checks_broken(self):
+        """
+        Probe a sample of the healthy backends again. Return True when they
+        all fail, the checks not working from here.
+        """
+        sample = sorted(self.healthy)[:HEALTHY_SAMPLE]
+        if not sample:
+            return False
+        results = asyncio.run(self.probe_all([(ip, port) for _, ip, port in sample]))
+        return not any(results)
+
+    def check(self, instances):
+        """
+        Probe the backends not known to be healthy yet and return
+        {pool: {name: ready}}. Every backend is ready when the healthy
+        backends fail their probe as well.
+        """
+        current = set()
+        todo = []
+        for members in instances.values():
+            for backend in members:
+                key = self.key(backend)
+                if key not in current and key not in self.healthy:
+                    todo.append(key)
+                current.add(key)
+        # Backends which left the inventory are probed again if they come back
+        self.healthy &= current
+
+        if todo:
+            results = asyncio.run(self.probe_all([(ip, port) for _, ip, port in todo]))
+            for key, ready in zip(todo, results):
+                if ready:
+                    self.healthy.add(key)
+            self.log.debug("Pre-flight : %d of %d new backends ready", sum(1 for ready in results if ready), len(todo))
+            if not any(results) and self.checks_broken():
+                self.log.warning("Pre-flight : healthy backends fail their probe too. Skipping the checks")
+                return dict((pool, dict((backend.name, True) for backend in members))
+                            for pool, members in instances.items())
+
+        return dict((pool, dict((backend.name, self.key(backend) in self.healthy) for backend in members))
+                    for pool, members in instances.items())
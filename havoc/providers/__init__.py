@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Provider plugins
+
+Every provider module exposes configured(config), telling whether the
+provider is set up, and connect(config, log), returning its client. Client
+libraries are imported by connect() only, so providers which are not
+configured never load them.
+"""
+
+import importlib
+
+# Discovery providers, in lookup order
+PROVIDERS = (
+    ('ec2', 'havoc.providers.ec2'),
+    ('openstack', 'havoc.providers.nova'),
+    ('static', 'havoc.providers.static'),
+    ('leader', 'havoc.providers.leader'),
+)
+
+
+def get_provider(name):
+    """
+    Return the module of a provider
+    """
+    return importlib.import_module(dict(PROVIDERS)[name])
+
+
+def connect_providers(config, log):
+    """
+    Return {name: client} for every configured provider
+    """
+    clients = {}
+    for name, _ in PROVIDERS:
+        provider = get_provider(name)
+        if provider.configured(config):
+            clients[name] = provider.connect(config, log)
+    return clients
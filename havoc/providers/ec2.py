@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - AWS EC2 provider
+"""
+
+
+class EC2Account(object):
+    """
+    An EC2 region and set of credentials. The connection is created once and
+    reused by every cycle. Only the instances of zone are listed when set.
+    """
+
+    def __init__(self, connection, region=None, name=None, timeout=None, zone=None):
+        self.connection = connection
+        self.region = region
+        self.name = name or region
+        self.timeout = timeout
+        self.zone = zone
+
+    @property
+    def provider(self):
+        return 'ec2:%s' % self.name if self.name else 'ec2'
+
+    @property
+    def label(self):
+        return 'EC2 %s' % self.name if self.name else 'EC2'
+
+
+def configured(config):
+    return bool(config.get('aws_accounts')) or config.get('aws_access_key_id') is not None
+
+
+def connect(config, log):
+    """
+    Return the EC2 connection of the overflow region, or a list of EC2Account
+    when several regions or accounts are configured
+    """
+    import boto.ec2
+
+    if not config.get('aws_accounts') and not config.get('aws_regions'):
+        aws_region = config.get('overflow_aws_region') if config.get('overflow_aws_region') else "us-east-1"
+        log.debug("Creating EC2 Provider, AWS Key ID: %s", config.get('aws_access_key_id'))
+        return boto.ec2.connect_to_region(
+                aws_region, aws_access_key_id=config.get('aws_access_key_id'), aws_secret_access_key=config.get('aws_secret_access_key')
+                )
+
+    # aws_accounts in the configuration file lists {name, region, zone,
+    # access_key_id, secret_access_key, timeout} entries, while --aws-regions
+    # reuses the default credentials for each region. The overflow zone only
+    # applies to the region it belongs to.
+    accounts = []
+    default_timeout = config.get('aws_region_timeout') or None
+    overflow_zone = config.get('overflow_aws_zone')
+    for entry in config.get('aws_accounts') or []:
+        log.debug("Creating EC2 Provider %s in %s, AWS Key ID: %s", entry.get('name'), entry['region'], entry.get('access_key_id'))
+        connection = boto.ec2.connect_to_region(
+                entry['region'], aws_access_key_id=entry.get('access_key_id'), aws_secret_access_key=entry.get('secret_access_key')
+                )
+        accounts.append(EC2Account(connection, entry['region'], entry.get('name'), entry.get('timeout') or default_timeout,
+                                   entry.get('zone')))
+
+    if config.get('aws_regions') and config.get('aws_access_key_id') is not None:
+        for region in config.get('aws_regions').split(','):
+            region = region.strip()
+            log.debug("Creating EC2 Provider in %s, AWS Key ID: %s", region, config.get('aws_access_key_id'))
+            connection = boto.ec2.connect_to_region(
+                    region, aws_access_key_id=config.get('aws_access_key_id'), aws_secret_access_key=config.get('aws_secret_access_key')
+                    )
+            zone = overflow_zone if overflow_zone and overflow_zone.startswith(region) else None
+            accounts.append(EC2Account(connection, region, timeout=default_timeout, zone=zone))
+    return accounts
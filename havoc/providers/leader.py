@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Leader provider
+
+Followers get their inventory from the leader HAvOC instead of the cloud
+providers.
+"""
+
+from havoc.share import SharedInventory
+
+
+def configured(config):
+    return config.get('leader_url') is not None
+
+
+def connect(config, log):
+    log.debug("Following the inventory of %s", config.get('leader_url'))
+    return SharedInventory(config.get('leader_url'), config.get('leader_timeout') or 10, log)
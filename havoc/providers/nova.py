@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Openstack Nova provider
+"""
+
+
+def configured(config):
+    return config.get('os_username') is not None
+
+
+def connect(config, log):
+    from novaclient import client
+
+    log.debug("Creating Openstack Provider, User: %s", config.get('os_username'))
+    return client.Client("2",
+            auth_url=config.get('os_auth_url'), username=config.get('os_username'), api_key=config.get('os_password'), project_id=config.get('os_project_id')
+            )
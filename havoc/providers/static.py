@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Static file provider
+
+Serves backends listed in a YAML (or JSON) file, for hosts living outside of
+the cloud providers :
+
+    appa:
+      - name: web1
+        ip: 10.0.0.1
+        port: 8080
+        zone: dc1
+        tags: {role: web}
+"""
+
+import os
+
+from havoc.records import from_static_entry
+
+
+class StaticInventory(object):
+    """
+    Backends of a static file. The file is parsed again only when it changed.
+    """
+
+    def __init__(self, path, log):
+        self.path = path
+        self.log = log
+        self.stamp = None
+        self.pools = {}
+
+    def read(self):
+        import yaml
+
+        stamp = os.stat(self.path)
+        stamp = (stamp.st_mtime, stamp.st_size)
+        if stamp != self.stamp:
+            with open(self.path, 'r') as handle:
+                self.pools = yaml.safe_load(handle) or {}
+            self.stamp = stamp
+            self.log.debug("Loaded static inventory %s", self.path)
+        return self.pools
+
+    def list_instances(self, pools, suffix=None, keep_tags=None):
+        """
+        Return {pool: [Backend]} for the pools of the file
+        """
+        entries = self.read()
+        return dict((pool, [from_static_entry(entry, pool, suffix, keep_tags) for entry in entries.get(pool) or []])
+                    for pool in pools)
+
+
+def configured(config):
+    return config.get('static_file') is not None
+
+
+def connect(config, log):
+    log.debug("Creating Static Provider, File: %s", config.get('static_file'))
+    return StaticInventory(config.get('static_file'), log)
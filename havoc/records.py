@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Provider-neutral backend records
+
+Discovery normalizes boto instances and novaclient servers into Backend
+records once, so the provider objects and their response payloads are not
+kept alive, and templates see the same attributes for every provider.
+"""
+
+
+class Backend(object):
+    """
+    A backend server. ip_address is kept as an alias of ip for the existing
+    templates, and unknown attributes are looked up in the tags.
+    """
+
+    __slots__ = ('name', 'ip', 'port', 'pool', 'provider', 'region', 'zone', 'tags')
+
+    def __init__(self, name, ip, pool, provider, port=None, region=None, zone=None, tags=None):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.pool = pool
+        self.provider = provider
+        self.region = region
+        self.zone = zone
+        self.tags = tags if tags is not None else {}
+
+    @property
+    def ip_address(self):
+        return self.ip
+
+    @ip_address.setter
+    def ip_address(self, value):
+        self.ip = value
+
+    def __getattr__(self, name):
+        # Only called for attributes which are not set. Private names and
+        # unset tags (copy, unpickling) must not be looked up in the tags.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return object.__getattribute__(self, 'tags')[name]
+        except (AttributeError, KeyError, TypeError):
+            raise AttributeError(name)
+
+    def __eq__(self, other):
+        return isinstance(other, Backend) and self.astuple() == other.astuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.name, self.ip, self.port, self.pool, self.provider, self.region, self.zone))
+
+    def __repr__(self):
+        return '<Backend %s %s:%s pool=%s provider=%s>' % (self.name, self.ip, self.port, self.pool, self.provider)
+
+    def astuple(self):
+        return (self.name, self.ip, self.port, self.pool, self.provider, self.region, self.zone, self.tags)
+
+
+def select_tags(tags, keep=None):
+    """
+    Return the tags to keep on a record. All the tags are kept when keep is None.
+    """
+    if keep is None:
+        return dict(tags)
+    return dict((k, tags[k]) for k in keep if k in tags)
+
+
+def get_port(tags):
+    try:
+        return int(tags['port'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def from_ec2_instance(instance, pool, suffix=None, keep_tags=None, region=None):
+    tags = instance.tags
+    if 'hostname' in tags:
+        name = tags['hostname'] if suffix is None else tags['hostname'] + suffix
+    else:
+        name = instance.public_dns_name
+    return Backend(name, instance.ip_address, pool, 'ec2',
+                   port=get_port(tags),
+                   region=region,
+                   zone=getattr(instance, 'placement', None),
+                   tags=select_tags(tags, keep_tags))
+
+
+def from_os_server(server, pool, ip, suffix=None, keep_tags=None):
+    metadata = server.metadata
+    name = server.name if suffix is None else server.name + suffix
+    return Backend(name, ip, pool, 'openstack',
+                   port=get_port(metadata),
+                   zone=getattr(server, 'OS-EXT-AZ:availability_zone', None),
+                   tags=select_tags(metadata, keep_tags))
+
+
+def from_static_entry(entry, pool, suffix=None, keep_tags=None):
+    tags = entry.get('tags') or {}
+    name = entry['name'] if suffix is None else entry['name'] + suffix
+    port = entry.get('port')
+    return Backend(name, entry['ip'], pool, 'static',
+                   port=int(port) if port is not None else get_port(tags),
+                   region=entry.get('region'),
+                   zone=entry.get('zone'),
+                   tags=select_tags(tags, keep_tags))
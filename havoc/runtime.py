@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - HAproxy Runtime API
+
+Apply backend membership changes through the admin stats sockets instead of
+reloading HAproxy, when the structure of the configuration did not change.
+"""
+
+import re
+import socket
+
+SECTION_RE = re.compile(r'^\s*(backend|listen|frontend|defaults|global|peers|resolvers|userlist)\b\s*(\S*)')
+SERVER_RE = re.compile(r'^(\s*server\s+)(\S+)\s+(\S+)(.*)$')
+SOCKET_RE = re.compile(r'^\s*stats\s+socket\s+(\S+)(.*)$')
+
+# Non empty answers of the Runtime API meaning the command has been applied
+RUNTIME_OK = ('IP changed from', 'no need to change', 'Port changed from')
+
+
+class RuntimeAPIError(Exception):
+    pass
+
+
+def split_address(address):
+    """
+    Split a server address into (ip, port). The port is None when not defined.
+    """
+    if address.startswith('['):
+        ip, _, port = address[1:].partition(']')
+        return ip, port.lstrip(':') or None
+    if address.count(':') == 1:
+        ip, port = address.split(':')
+        return ip, port or None
+    return address, None
+
+
+def parse_config(config_data):
+    """
+    Return the structure of a configuration and the state of its servers.
+
+    The structure is the configuration without server addresses and without
+    the disabled keyword on server lines. Servers are indexed by
+    (backend, server) and hold (ip, port, disabled).
+    """
+    skeleton = []
+    servers = {}
+    section = None
+    for line in config_data.splitlines():
+        res = SECTION_RE.match(line)
+        if res is not None:
+            section = res.group(2) if res.group(1) in ('backend', 'listen') else None
+
+        res = SERVER_RE.match(line)
+        if res is None or section is None:
+            skeleton.append(line.rstrip())
+            continue
+
+        name = res.group(2)
+        params = res.group(4).split()
+        disabled = 'disabled' in params
+        ip, port = split_address(res.group(3))
+        servers[(section, name)] = (ip, port, disabled)
+        skeleton.append('%s%s %s' % (res.group(1), name, ' '.join(p for p in params if p != 'disabled')))
+
+    return '\n'.join(skeleton), servers
+
+
+def find_stats_sockets(config_data):
+    """
+    Return the admin level stats sockets declared in a configuration
+    """
+    sockets = []
+    for line in config_data.splitlines():
+        res = SOCKET_RE.match(line)
+        if res is not None and 'level admin' in ' '.join(res.group(2).split()):
+            sockets.append(res.group(1))
+    return sockets
+
+
+def plan_runtime_commands(old_config, new_config):
+    """
+    Return the Runtime API commands turning old_config into new_config, or None
+    when the change is structural and needs a reload.
+    """
+    old_skeleton, old_servers = parse_config(old_config)
+    new_skeleton, new_servers = parse_config(new_config)
+    if old_skeleton != new_skeleton:
+        return None
+
+    commands = []
+    for key in sorted(new_servers):
+        backend, server = key
+        ip, port, disabled = new_servers[key]
+        old_ip, old_port, old_disabled = old_servers[key]
+        target = '%s/%s' % (backend, server)
+        if (ip, port) != (old_ip, old_port):
+            if port is None:
+                commands.append('set server %s addr %s' % (target, ip))
+            else:
+                commands.append('set server %s addr %s port %s' % (target, ip, port))
+        if disabled != old_disabled:
+            commands.append('set server %s state %s' % (target, 'maint' if disabled else 'ready'))
+    return commands
+
+
+def parse_map(map_data):
+    """
+    Return the {key: value} entries of a HAproxy map file
+    """
+    entries = {}
+    for line in map_data.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        key, _, value = line.partition(' ')
+        entries[key] = value.strip()
+    return entries
+
+
+def plan_map_commands(path, old_map, new_map):
+    """
+    Return the Runtime API commands turning the entries of old_map into the
+    ones of new_map
+    """
+    old_entries = parse_map(old_map)
+    new_entries = parse_map(new_map)
+    commands = []
+    for key in sorted(old_entries):
+        if key not in new_entries:
+            commands.append('del map %s %s' % (path, key))
+    for key in sorted(new_entries):
+        if key not in old_entries:
+            commands.append('add map %s %s %s' % (path, key, new_entries[key]))
+        elif new_entries[key] != old_entries[key]:
+            commands.append('set map %s %s %s' % (path, key, new_entries[key]))
+    return commands
+
+
+class RuntimeAPI(object):
+    """
+    Send commands to every HAproxy process through its stats socket
+    """
+
+    def __init__(self, sockets, timeout=2):
+        self.sockets = sockets
+        self.timeout = timeout
+
+    def send(self, path, command):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(path)
+            sock.sendall((command + '\n').encode())
+            chunks = []
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            sock.close()
+        return b''.join(chunks).decode(errors='replace').strip()
+
+    def apply(self, commands):
+        """
+        Run the commands on every socket. Raise RuntimeAPIError at the first
+        command which is refused or cannot be sent.
+        """
+        for path in self.sockets:
+            for command in commands:
+                try:
+                    answer = self.send(path, command)
+                except (IOError, OSError) as e:
+                    raise RuntimeAPIError("Cannot send '%s' to %s : %s" % (command, path, e))
+                if answer and not answer.startswith(RUNTIME_OK):
+                    raise RuntimeAPIError("HAproxy refused '%s' on %s : %s" % (command, path, answer))
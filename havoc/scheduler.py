@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Daemon scheduler
+
+Run HAvOC cycles at a fixed rate with optional jitter, back off exponentially
+while providers fail, and re-render from the cached inventory as soon as a
+watched file (template, configuration) changes.
+"""
+
+import os
+import random
+import re
+import time
+
+
+TIME_UNITS = {
+    's': 1, 'sec': 1, 'secs': 1, 'second': 1, 'seconds': 1,
+    'm': 60, 'min': 60, 'mins': 60, 'minute': 60, 'minutes': 60,
+    'h': 3600, 'hour': 3600, 'hours': 3600,
+}
+
+
+def parse_duration(value):
+    """
+    Return the number of seconds of a duration : a number of seconds or a
+    string like 30s, 30sec, 5min or 1hour. Raise ValueError otherwise.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if value < 0:
+            raise ValueError("Negative duration : %s" % value)
+        return value
+    res = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([a-z]*)\s*$", str(value).lower())
+    if res is None or (res.group(2) and res.group(2) not in TIME_UNITS):
+        raise ValueError("Invalid duration '%s', expected seconds or a value like 30sec, 5min, 1hour" % value)
+    seconds = float(res.group(1)) * TIME_UNITS.get(res.group(2), 1)
+    return int(seconds) if seconds.is_integer() else seconds
+
+
+def time_str_to_sec(time):
+    try:
+        return parse_duration(time)
+    except ValueError:
+        # Default on 5min
+        return 300
+
+
+def parse_pool_settings(settings):
+    """
+    Return {pool: (refresh interval in seconds or None, priority)} from the
+    pool_settings of the configuration. Raise ValueError on invalid entries.
+    """
+    if not settings:
+        return {}
+    if not isinstance(settings, dict):
+        raise ValueError("pool_settings must map pools to their settings")
+    parsed = {}
+    for pool, entry in settings.items():
+        entry = entry or {}
+        if not isinstance(entry, dict):
+            raise ValueError("pool_settings of pool %s must be a mapping" % pool)
+        unknown = set(entry) - set(['interval', 'priority'])
+        if unknown:
+            raise ValueError("Unknown pool_settings of pool %s : %s" % (pool, ', '.join(sorted(unknown))))
+        interval = entry.get('interval')
+        try:
+            interval = parse_duration(interval) if interval is not None else None
+            priority = int(entry.get('priority') or 0)
+        except (TypeError, ValueError) as e:
+            raise ValueError("Invalid pool_settings of pool %s : %s" % (pool, e))
+        if interval == 0:
+            raise ValueError("Invalid pool_settings of pool %s : the interval must be positive" % pool)
+        parsed[pool] = (interval, priority)
+    return parsed
+
+
+def file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+class Scheduler(object):
+
+    def __init__(self, havoc, log, interval, jitter=0, backoff_max=None, watch=None, on_change=None,
+                 tick=1, clock=time.time, sleep=time.sleep):
+        self.havoc = havoc
+        self.log = log
+        self.interval = interval
+        self.jitter = jitter
+        self.backoff_max = backoff_max if backoff_max is not None else interval * 8
+        self.on_change = on_change
+        self.tick = tick
+        self.clock = clock
+        self.sleep = sleep
+        self.failures = 0
+        self.watched = dict((path, file_stamp(path)) for path in (watch or []) if path)
+
+    def next_delay(self):
+        """
+        Return the delay between the start of the last cycle and the next one
+        """
+        delay = self.interval
+        if self.failures:
+            delay = min(self.interval * 2 ** self.failures, max(self.backoff_max, self.interval))
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        return delay
+
+    def run_cycle(self):
+        try:
+            ok = self.havoc.run() == 0 and not self.havoc.discovery_errors
+        except Exception as e:
+            self.log.error("HAvOC run failed : %s", e)
+            ok = False
+
+        if ok:
+            self.failures = 0
+        else:
+            self.failures += 1
+            self.log.warning("HAvOC run failed %d time(s) in a row. Backing off", self.failures)
+        return ok
+
+    def changed_files(self):
+        changed = []
+        for path, stamp in self.watched.items():
+            current = file_stamp(path)
+            if current != stamp:
+                self.watched[path] = current
+                changed.append(path)
+        return changed
+
+    def wait_until(self, deadline):
+        """
+        Sleep until deadline, re-rendering on file changes and running
+        deferred reloads in the meantime
+        """
+        while True:
+            now = self.clock()
+            if now >= deadline:
+                return
+            changed = self.changed_files()
+            if changed:
+                self.log.info("%s changed. Rendering HAproxy configuration from cached instances", ', '.join(changed))
+                if self.on_change is not None:
+                    self.on_change(changed)
+                try:
+                    self.havoc.render()
+                except Exception as e:
+                    self.log.error("HAvOC render failed : %s", e)
+            if self.havoc.governor.due():
+                self.havoc.flush_reload()
+            self.sleep(min(self.tick, deadline - now))
+
+    def run_forever(self):
+        while True:
+            started = self.clock()
+            self.run_cycle()
+            delay = self.next_delay()
+            self.log.debug("Wait for next run : %d sec", max(0, started + delay - self.clock()))
+            self.wait_until(started + delay)
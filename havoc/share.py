@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Shared inventory
+
+A leader HAvOC does the discovery and publishes its inventory as gzip JSON on
+http://address:port/inventory. Followers fetch it with conditional requests
+and render their configuration locally, so the provider APIs are queried by
+the leader only, whatever the number of HAproxy nodes.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from havoc.records import Backend
+
+SHARE_FORMAT = 1
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class InventoryPublisher(object):
+    """
+    Latest inventory of the leader. The version is bumped and the payload
+    compressed again only when the inventory changed.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.version = 0
+        self.etag = None
+        self.payload = None
+
+    def publish(self, instances, stale=None):
+        pools = dict((pool, [[b.name, b.ip_address, b.port, b.provider, b.region, b.zone, b.tags]
+                             for b in sorted(members, key=lambda m: m.name)])
+                     for pool, members in instances.items())
+        content = json.dumps({'pools': pools, 'stale': stale or {}}, sort_keys=True, separators=(',', ':'))
+        etag = '"%s"' % hashlib.sha1(content.encode()).hexdigest()
+        with self.lock:
+            if etag == self.etag:
+                return False
+            version = self.version + 1
+        data = {'format': SHARE_FORMAT, 'version': version, 'time': self.clock(), 'pools': pools, 'stale': stale or {}}
+        payload = gzip.compress(json.dumps(data, separators=(',', ':')).encode())
+        with self.lock:
+            self.version, self.etag, self.payload = version, etag, payload
+        return True
+
+    def get(self):
+        with self.lock:
+            return self.version, self.etag, self.payload
+
+
+def start_share_server(publisher, port, address='127.0.0.1'):
+    """
+    Serve the inventory of publisher on http://address:port/inventory from a
+    daemon thread
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/inventory':
+                self.send_error(404)
+                return
+            version, etag, payload = publisher.get()
+            if payload is None:
+                self.send_error(503, 'No inventory yet')
+                return
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(payload)))
+            self.send_header('ETag', etag)
+            self.send_header('X-Havoc-Inventory-Version', str(version))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer((address, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='havoc-share')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class SharedInventory(object):
+    """
+    Follower side : fetch the inventory of the leader, downloading it again
+    only when its ETag changed
+    """
+
+    def __init__(self, url, timeout=10, log=None):
+        self.url = url
+        self.timeout = timeout
+        self.log = log
+        self.etag = None
+        self.version = None
+        self.pools = {}
+        self.stale = {}
+
+    def fetch(self):
+        """
+        Return True when a new inventory has been downloaded
+        """
+        request = Request(self.url)
+        if self.etag is not None:
+            request.add_header('If-None-Match', self.etag)
+        try:
+            response = urlopen(request, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 304:
+                return False
+            raise
+
+        data = json.loads(gzip.decompress(response.read()).decode())
+        if data.get('format') != SHARE_FORMAT:
+            raise ValueError("Unsupported inventory format %s" % data.get('format'))
+        self.pools = data['pools']
+        self.stale = data.get('stale') or {}
+        self.version = data['version']
+        self.etag = response.headers.get('ETag')
+        self.log.debug("Fetched inventory version %s from %s", self.version, self.url)
+        return True
+
+    def list_instances(self, pools):
+        """
+        Return {pool: [Backend]} for the pools of the leader inventory
+        """
+        self.fetch()
+        instances = {}
+        for pool in pools:
+            instances[pool] = [Backend(name, ip, pool, provider, port=port, region=region, zone=zone, tags=tags)
+                               for name, ip, port, provider, region, zone, tags in self.pools.get(pool, [])]
+        return instances
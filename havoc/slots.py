@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Stable server slots
+
+Every backend gets a slot of its pool and keeps it for as long as it exists,
+across cycles and restarts. Freed slots are reused by the next backends and
+every pool keeps spare slots rendered as disabled placeholders, so scaling a
+pool flips existing server lines instead of shifting the whole backend.
+
+Templates read the slot table instead of the sorted instances :
+
+    {% for s in slots['appa'] %}server {{s.name}} {{s.ip_address}}:80 check{% if not s.enabled %} disabled{% endif %}
+    {% endfor %}
+"""
+
+import json
+import os
+import tempfile
+
+SLOTS_VERSION = 1
+
+# Address of the disabled placeholders
+PLACEHOLDER_IP = '127.0.0.1'
+
+
+class Slot(object):
+    """
+    A server line of a pool, holding a backend or nothing
+    """
+
+    __slots__ = ('pool', 'index', 'backend')
+
+    def __init__(self, pool, index, backend=None):
+        self.pool = pool
+        self.index = index
+        self.backend = backend
+
+    @property
+    def name(self):
+        return 'slot%d' % self.index
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    @property
+    def ip_address(self):
+        return self.backend.ip_address if self.backend is not None else PLACEHOLDER_IP
+
+    @property
+    def port(self):
+        return getattr(self.backend, 'port', None)
+
+    def __repr__(self):
+        if self.backend is None:
+            return '<Slot %s/%s>' % (self.pool, self.name)
+        return '<Slot %s/%s %s %s>' % (self.pool, self.name, self.backend.name, self.ip_address)
+
+
+class SlotAllocator(object):
+    """
+    Assign backends to stable slots. The assignments ({pool: [name or None]})
+    are persisted to path when one is given.
+    """
+
+    def __init__(self, spares=0, path=None, log=None):
+        self.spares = spares
+        self.path = path
+        self.log = log
+        self.pools = {}
+
+    def load(self):
+        if not self.path:
+            return False
+        try:
+            with open(self.path, 'r') as handle:
+                data = json.load(handle)
+        except (IOError, OSError, ValueError) as e:
+            self.log.debug("Cannot load slots %s : %s", self.path, e)
+            return False
+
+        if data.get('version') != SLOTS_VERSION:
+            self.log.warning("Ignoring slots %s with version %s", self.path, data.get('version'))
+            return False
+
+        self.pools = data.get('pools', {})
+        self.log.debug("Loaded slots %s", self.path)
+        return True
+
+    def save(self):
+        if not self.path:
+            return True
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.havoc-slots-')
+            with os.fdopen(fd, 'w') as handle:
+                json.dump({'version': SLOTS_VERSION, 'pools': self.pools}, handle, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            self.log.error("Cannot write slots %s : %s", self.path, e)
+            return False
+        return True
+
+    def assign(self, pool, members):
+        """
+        Update the slots of a pool for its current members and return
+        [name or None] for every slot. Return True as second value when the
+        assignments changed.
+        """
+        previous = self.pools.get(pool, [])
+        names = set(member.name for member in members)
+        slots = [name if name in names else None for name in previous]
+
+        placed = set(name for name in slots if name is not None)
+        free = [idx for idx, name in enumerate(slots) if name is None]
+        free.reverse()
+        for name in sorted(names - placed):
+            if free:
+                slots[free.pop()] = name
+            else:
+                slots.append(name)
+
+        # Keep exactly enough spare slots, trimming the trailing ones only
+        # once twice the spares are free to avoid growing and shrinking the
+        # pool on every scale event
+        empty = slots.count(None)
+        if empty < self.spares:
+            slots.extend([None] * (self.spares - empty))
+        elif empty > 2 * self.spares:
+            while slots and slots[-1] is None and slots.count(None) > self.spares:
+                slots.pop()
+
+        self.pools[pool] = slots
+        return slots, slots != previous
+
+    def allocate(self, instances):
+        """
+        Return the slot table {pool: [Slot]} of the instances ({pool: [Backend]})
+        """
+        table = {}
+        changed = False
+        for pool in sorted(instances):
+            members = dict((member.name, member) for member in instances[pool])
+            names, pool_changed = self.assign(pool, instances[pool])
+            changed = changed or pool_changed
+            table[pool] = [Slot(pool, idx + 1, members.get(name) if name is not None else None)
+                           for idx, name in enumerate(names)]
+        if changed:
+            self.save()
+        return table
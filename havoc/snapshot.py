@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Persistent inventory snapshot
+
+Keep the last good inventory of every provider and pool in a compact local
+file (gzipped JSON), so a pool can be served from it when its provider is
+failing or slow, and right away when HAvOC starts.
+"""
+
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+
+from havoc.records import Backend
+
+SNAPSHOT_VERSION = 2
+
+
+class Snapshot(object):
+
+    def __init__(self, path, log):
+        self.path = path
+        self.log = log
+        self.lock = threading.Lock()
+        # {provider: {pool: (timestamp, [Backend])}}
+        self.providers = {}
+        self.dirty = False
+
+    def load(self):
+        try:
+            with gzip.open(self.path, 'rt') as handle:
+                data = json.load(handle)
+        except (IOError, OSError, ValueError) as e:
+            self.log.debug("Cannot load inventory snapshot %s : %s", self.path, e)
+            return False
+
+        if data.get('version') != SNAPSHOT_VERSION:
+            self.log.warning("Ignoring inventory snapshot %s with version %s", self.path, data.get('version'))
+            return False
+
+        providers = {}
+        for provider, pools in data.get('providers', {}).items():
+            providers[provider] = {}
+            for pool, entry in pools.items():
+                backends = [Backend(name, ip, pool, provider.split(':')[0], port=port, region=region, zone=zone, tags=tags)
+                            for name, ip, port, region, zone, tags in entry['backends']]
+                providers[provider][pool] = (entry['time'], backends)
+        with self.lock:
+            self.providers = providers
+            self.dirty = False
+        self.log.debug("Loaded inventory snapshot %s", self.path)
+        return True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return True
+            data = {'version': SNAPSHOT_VERSION, 'providers': {}}
+            for provider, pools in self.providers.items():
+                data['providers'][provider] = dict(
+                    (pool, {'time': timestamp, 'backends': [[b.name, b.ip, b.port, b.region, b.zone, b.tags] for b in backends]})
+                    for pool, (timestamp, backends) in pools.items())
+            self.dirty = False
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.havoc-snapshot-')
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as handle:
+                handle.write(json.dumps(data, separators=(',', ':')).encode())
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            self.log.error("Cannot write inventory snapshot %s : %s", self.path, e)
+            return False
+        return True
+
+    def update(self, provider, instances, now=None):
+        """
+        Store the instances ({pool: [Backend]}) freshly retrieved from provider
+        """
+        now = now if now is not None else time.time()
+        with self.lock:
+            pools = self.providers.setdefault(provider, {})
+            for pool, backends in instances.items():
+                pools[pool] = (now, list(backends))
+            self.dirty = True
+
+    def get(self, provider, pools, max_age=None, now=None):
+        """
+        Return {pool: (age, [Backend])} for the pools of provider in the
+        snapshot, leaving out the ones older than max_age seconds
+        """
+        now = now if now is not None else time.time()
+        found = {}
+        with self.lock:
+            stored = self.providers.get(provider, {})
+            for pool in pools:
+                if pool not in stored:
+                    continue
+                timestamp, backends = stored[pool]
+                age = now - timestamp
+                if max_age and age > max_age:
+                    continue
+                found[pool] = (age, backends)
+        return found
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Jinja2 environment and compiled template cache
+"""
+
+import os
+
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, TemplateNotFound
+
+from havoc.filters import discover_filters
+
+
+def template_stamp(path):
+    """
+    Return the (mtime, size) of a template, used to invalidate compiled templates
+    """
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size)
+
+
+class PathLoader(BaseLoader):
+    """
+    Load templates from their filesystem path. Compiled templates are kept by
+    the environment until the mtime or the size of the file changes.
+    """
+
+    def get_source(self, environment, template):
+        try:
+            stamp = template_stamp(template)
+            with open(template, 'r') as handle:
+                source = handle.read()
+        except (IOError, OSError):
+            raise TemplateNotFound(template)
+
+        def uptodate():
+            try:
+                return template_stamp(template) == stamp
+            except OSError:
+                return False
+
+        return source, template, uptodate
+
+
+def build_environment(bytecode_cache_dir=None):
+    """
+    Build the long-lived Jinja2 environment used to render HAproxy configurations
+    """
+    bytecode_cache = None
+    if bytecode_cache_dir is not None:
+        if not os.path.isdir(bytecode_cache_dir):
+            os.makedirs(bytecode_cache_dir)
+        bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+
+    jinja_env = Environment(loader=PathLoader(), bytecode_cache=bytecode_cache, auto_reload=True)
+    jinja_env.filters.update(discover_filters())
+    return jinja_env
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+HAvOC - Provider request throttling
+
+Every provider API call goes through a Throttle of its provider/region: a
+token bucket spaces the requests, throttling errors are retried with
+exponential backoff and full jitter, the request rate is halved on every
+throttling error and recovers slowly on success, and no request nor retry
+goes past the deadline of the discovery cycle.
+"""
+
+import random
+import threading
+import time
+
+# Error codes of boto EC2ResponseError meaning the request was throttled
+EC2_THROTTLING_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+# HTTP status of novaclient errors meaning the request was throttled
+NOVA_THROTTLING_STATUS = (413, 429, 503)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def is_throttling_error(error):
+    """
+    Return True for the EC2 and Nova errors worth retrying later
+    """
+    if getattr(error, 'error_code', None) in EC2_THROTTLING_CODES:
+        return True
+    status = getattr(error, 'http_status', None) or getattr(error, 'code', None)
+    return status in NOVA_THROTTLING_STATUS
+
+
+class TokenBucket(object):
+    """
+    Allow rate requests per second on average and bursts of burst requests.
+    A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, rate):
+        """
+        Take a token and return the number of seconds to wait before using it
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= 1
+            return -self.tokens / rate if self.tokens < 0 else 0
+
+    def acquire(self, rate=None, deadline=None):
+        rate = rate if rate is not None else self.rate
+        if not rate:
+            return
+        wait = self.reserve(rate)
+        if deadline is not None and self.clock() + wait > deadline:
+            with self.lock:
+                self.tokens += 1
+            raise DeadlineExceeded("Request budget exhausted before the cycle deadline")
+        if wait > 0:
+            self.sleep(wait)
+
+
+class Throttle(object):
+    """
+    Request layer of a provider/region
+    """
+
+    def __init__(self, name, rate=0, burst=1, retries=4, base_delay=0.5, max_delay=20, max_slowdown=16,
+                 on_throttle=None, clock=time.time, sleep=time.sleep):
+        self.name = name
+        self.rate = rate
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_slowdown = max_slowdown
+        self.on_throttle = on_throttle
+        self.clock = clock
+        self.sleep = sleep
+        self.bucket = TokenBucket(rate, burst, clock, sleep)
+        self.lock = threading.Lock()
+        # Divider of the request rate, raised by throttling errors
+        self.slowdown = 1.0
+        # Counters
+        self.requests = 0
+        self.throttled = 0
+
+    def current_rate(self):
+        return self.rate / self.slowdown if self.rate else 0
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt)) * self.slowdown
+        return random.uniform(0, min(self.max_delay, delay))
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs), retrying throttling errors. The deadline
+        keyword argument is the timestamp no request may start after.
+        """
+        deadline = kwargs.pop('deadline', None)
+        attempt = 0
+        while True:
+            if deadline is not None and self.clock() >= deadline:
+                raise DeadlineExceeded("Deadline of the cycle reached before calling %s" % self.name)
+            self.bucket.acquire(self.current_rate(), deadline)
+            with self.lock:
+                self.requests += 1
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_throttling_error(e) or attempt >= self.retries:
+                    raise
+                with self.lock:
+                    self.throttled += 1
+                    self.slowdown = min(self.max_slowdown, self.slowdown * 2)
+                delay = self.backoff(attempt)
+                if self.on_throttle is not None:
+                    self.on_throttle(self, e, delay)
+                if deadline is not None and self.clock() + delay > deadline:
+                    raise DeadlineExceeded("%s is throttled past the deadline of the cycle : %s" % (self.name, e))
+                self.sleep(delay)
+                attempt += 1
+                continue
+
+            with self.lock:
+                self.slowdown = max(1.0, self.slowdown * 0.9)
+            return result
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+from havoc import filters
+from havoc.filters import render_scope
+from havoc.filters.index import filter_group_by
+from havoc.records import Backend
+
+
+def members():
+    return [Backend('web%d' % idx, '10.0.0.%d' % idx, 'appa', 'aws', zone='us-east-1%s' % 'ab'[idx % 2]) for idx in range(4)]
+
+
+def test_indexes_are_built_once_per_render():
+    pool = members()
+    with render_scope():
+        first = filter_group_by(pool, 'zone')
+        assert filter_group_by(pool, 'zone') is first
+    assert sorted(first) == ['us-east-1a', 'us-east-1b']
+
+    with render_scope():
+        assert filter_group_by(pool, 'zone') is not first
+
+
+def test_indexes_are_dropped_after_the_render():
+    pool = members()
+    with render_scope():
+        filter_group_by(pool, 'zone')
+    assert filters._renders.memo is None
+    # Outside of a render nothing is kept
+    assert filter_group_by(pool, 'zone') is not filter_group_by(pool, 'zone')
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import os
+
+import pytest
+
+from havoc.core import Havoc
+
+
+def make_havoc(path):
+    return Havoc(None, None, {'pools': 'appa', 'haproxy_cfg': str(path)}, logging.getLogger('havoc.test'))
+
+
+def test_write_keeps_mode(tmp_path):
+    path = tmp_path / 'haproxy.cfg'
+    path.write_text('old')
+    os.chmod(str(path), 0o640)
+
+    assert make_havoc(path).write_config(str(path), 'new')
+    assert path.read_text() == 'new'
+    assert os.stat(str(path)).st_mode & 0o7777 == 0o640
+    assert [name for name in os.listdir(str(tmp_path)) if name.startswith('.havoc-')] == []
+
+
+def test_write_replaces_symlink_target(tmp_path):
+    target_dir = tmp_path / 'releases'
+    target_dir.mkdir()
+    target = target_dir / 'haproxy.cfg'
+    target.write_text('old')
+    link = tmp_path / 'haproxy.cfg'
+    link.symlink_to(target)
+
+    assert make_havoc(link).write_config(str(link), 'new')
+    assert os.path.islink(str(link))
+    assert target.read_text() == 'new'
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="changing the owner needs root")
+def test_write_keeps_owner(tmp_path):
+    path = tmp_path / 'haproxy.cfg'
+    path.write_text('old')
+    os.chown(str(path), 1234, 1234)
+
+    assert make_havoc(path).write_config(str(path), 'new')
+    stat = os.stat(str(path))
+    assert (stat.st_uid, stat.st_gid) == (1234, 1234)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+
+from havoc.core import Havoc
+from havoc.metrics import Metrics
+from havoc.records import Backend
+
+
+class FakeStatic(object):
+
+    def __init__(self, pools):
+        self.pools = pools
+
+    def list_instances(self, pools, suffix=None, keep_tags=None):
+        return dict((pool, [Backend(name, '10.0.0.%d' % idx, pool, 'static') for idx, name in enumerate(self.pools.get(pool, []))])
+                    for pool in pools)
+
+
+def backend_series(metrics):
+    return dict((labels, value) for (name, labels), value in metrics.values.items() if name == 'havoc_backends')
+
+
+def test_replace_drops_old_series():
+    metrics = Metrics()
+    metrics.set('havoc_backends', 2, pool='appa', provider='static')
+    metrics.set('havoc_stale_pools', 1)
+    metrics.replace('havoc_backends', [(3, {'pool': 'appb', 'provider': 'static'})])
+
+    assert backend_series(metrics) == {(('pool', 'appb'), ('provider', 'static')): 3}
+    assert metrics.values[('havoc_stale_pools', ())] == 1
+
+
+def test_backends_gauge_follows_the_pools():
+    static = FakeStatic({'appa': ['web0', 'web1'], 'appb': ['web2']})
+    havoc = Havoc(None, None, {'pools': 'appa,appb', 'metrics_textfile': '/dev/null'},
+                  logging.getLogger('havoc.test'), static=static)
+
+    havoc.refresh(['appa', 'appb'])
+    assert backend_series(havoc.metrics)[(('pool', 'appa'), ('provider', 'static'))] == 2
+    assert backend_series(havoc.metrics)[(('pool', 'appb'), ('provider', 'static'))] == 1
+
+    havoc.refresh(['appa'])
+    assert not [labels for labels in backend_series(havoc.metrics) if ('pool', 'appb') in labels]
+    assert backend_series(havoc.metrics)[(('pool', 'appa'), ('provider', 'static'))] == 2
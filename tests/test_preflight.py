@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import socket
+import threading
+import time
+
+import pytest
+
+from havoc.preflight import Preflight
+from havoc.records import Backend
+
+log = logging.getLogger('havoc.test')
+
+
+@pytest.fixture
+def listeners():
+    sockets = []
+
+    def listen(backlog=5):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(backlog)
+        sockets.append(sock)
+        return sock
+
+    def open_port():
+        return listen().getsockname()[1]
+
+    def refused_port():
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def timeout_port():
+        # Fill the accept queue of a listener which never accepts, so new
+        # connections are left unanswered
+        sock = listen(0)
+        for _ in range(4):
+            client = socket.socket()
+            client.setblocking(False)
+            client.connect_ex(sock.getsockname())
+            sockets.append(client)
+        time.sleep(0.1)
+        return sock.getsockname()[1]
+
+    def http_port(status_line):
+        sock = listen()
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except OSError:
+                    return
+                with conn:
+                    conn.recv(4096)
+                    if status_line is not None:
+                        conn.sendall(status_line.encode() + b'\r\n\r\n')
+                    else:
+                        time.sleep(1)
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        return sock.getsockname()[1]
+
+    listen.open_port = open_port
+    listen.refused_port = refused_port
+    listen.timeout_port = timeout_port
+    listen.http_port = http_port
+    yield listen
+    for sock in sockets:
+        sock.close()
+
+
+def backend(name, port):
+    return Backend(name, '127.0.0.1', 'appa', 'static', port=port)
+
+
+def test_tcp_open_refused_and_timeout(listeners):
+    preflight = Preflight('tcp', timeout=0.5, log=log)
+    instances = {'appa': [backend('open', listeners.open_port()),
+                          backend('refused', listeners.refused_port()),
+                          backend('timeout', listeners.timeout_port())]}
+
+    started = time.time()
+    ready = preflight.check(instances)
+
+    assert ready == {'appa': {'open': True, 'refused': False, 'timeout': False}}
+    assert time.time() - started < 2
+
+
+def test_healthy_backends_are_not_probed_again(listeners):
+    preflight = Preflight('tcp', timeout=0.5, log=log)
+    open_backend = backend('open', listeners.open_port())
+    preflight.check({'appa': [open_backend]})
+
+    probed = []
+    preflight.probe_all = lambda targets: probed.extend(targets)
+    assert preflight.check({'appa': [open_backend]}) == {'appa': {'open': True}}
+    assert probed == []
+
+
+def test_http_status(listeners):
+    preflight = Preflight('http', timeout=0.5, log=log)
+    instances = {'appa': [backend('ok', listeners.http_port('HTTP/1.0 200 OK')),
+                          backend('error', listeners.http_port('HTTP/1.0 503 Service Unavailable')),
+                          backend('silent', listeners.http_port(None))]}
+
+    assert preflight.check(instances) == {'appa': {'ok': True, 'error': False, 'silent': False}}
+
+
+def test_new_backend_refusing_connections_stays_not_ready(listeners):
+    preflight = Preflight('tcp', timeout=0.5, log=log)
+    assert preflight.check({'appa': [backend('booting', listeners.refused_port())]}) == {'appa': {'booting': False}}
+
+    healthy = backend('open', listeners.open_port())
+    preflight.check({'appa': [healthy]})
+    instances = {'appa': [healthy, backend('booting', listeners.refused_port())]}
+    assert preflight.check(instances) == {'appa': {'open': True, 'booting': False}}
+
+
+def test_fail_open_when_healthy_backends_fail_too(listeners):
+    preflight = Preflight('tcp', timeout=0.5, log=log)
+    sock = listeners()
+    healthy = backend('open', sock.getsockname()[1])
+    assert preflight.check({'appa': [healthy]}) == {'appa': {'open': True}}
+
+    # The checks cannot reach the healthy backend anymore
+    sock.close()
+    instances = {'appa': [healthy, backend('new', listeners.refused_port())]}
+    assert preflight.check(instances) == {'appa': {'open': True, 'new': True}}
+    # Skipped checks do not make the new backends healthy
+    assert preflight.healthy == set([preflight.key(healthy)])
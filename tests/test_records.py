@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import copy
+import pickle
+
+import pytest
+
+from havoc.records import Backend
+
+
+def test_tags_as_attributes():
+    backend = Backend('web0', '10.0.0.1', 'appa', 'aws', tags={'role': 'web'})
+    assert backend.role == 'web'
+    with pytest.raises(AttributeError):
+        backend.missing
+
+
+def test_copy_and_pickle():
+    backend = Backend('web0', '10.0.0.1', 'appa', 'aws', port=80, tags={'role': 'web'})
+    for other in (copy.copy(backend), copy.deepcopy(backend), pickle.loads(pickle.dumps(backend))):
+        assert other == backend
+        assert other.role == 'web'
+
+
+def test_unset_tags_raise_attribute_error():
+    backend = Backend.__new__(Backend)
+    with pytest.raises(AttributeError):
+        backend.role
+    with pytest.raises(AttributeError):
+        backend.__getstate__x
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import time
+
+from havoc.core import Havoc
+from havoc.records import Backend
+
+
+class FakeStatic(object):
+    """
+    Static provider taking delay seconds to list the pools of slow
+    """
+
+    def __init__(self, members, slow=(), delay=0):
+        self.members = members
+        self.slow = slow
+        self.delay = delay
+        self.calls = []
+
+    def list_instances(self, pools, suffix=None, keep_tags=None):
+        self.calls.append(list(pools))
+        if any(pool in self.slow for pool in pools):
+            time.sleep(self.delay)
+        return dict((pool, [Backend(name, '10.0.0.1', pool, 'static') for name in self.members.get(pool, [])])
+                    for pool in pools)
+
+
+def make_havoc(static, **options):
+    settings = {'pools': 'appa,appb', 'interval': '1min',
+                'pool_settings': {'appa': {'priority': 10}, 'appb': {'priority': 0}}}
+    settings.update(options)
+    return Havoc(None, None, settings, logging.getLogger('havoc.test'), static=static)
+
+
+def test_single_sweep_without_deadline():
+    static = FakeStatic({'appa': ['web0'], 'appb': ['web1']})
+    havoc = make_havoc(static)
+
+    instances = havoc.refresh(['appb', 'appa'])
+
+    assert len(static.calls) == 1 and sorted(static.calls[0]) == ['appa', 'appb']
+    assert list(instances) == ['appa', 'appb']
+
+
+def test_high_priority_pools_first_with_deadline():
+    static = FakeStatic({'appa': ['web0'], 'appb': ['web1']})
+    havoc = make_havoc(static, discovery_deadline=10)
+
+    havoc.refresh(['appb', 'appa'])
+
+    assert static.calls == [['appa'], ['appb']]
+
+
+def test_low_priority_pools_keep_their_cache_past_the_deadline():
+    static = FakeStatic({'appa': ['web0'], 'appb': ['web1']}, slow=['appa'], delay=0.3)
+    havoc = make_havoc(static, discovery_deadline=0.2)
+    havoc.refresh(['appa', 'appb'], now=1000)
+    static.members = {'appa': ['web2'], 'appb': ['web3']}
+    static.calls = []
+
+    instances = havoc.refresh(['appa', 'appb'], now=2000)
+
+    assert static.calls == [['appa']]
+    assert [b.name for b in instances['appa']] == ['web2']
+    assert [b.name for b in instances['appb']] == ['web1']
+    assert havoc.pool_refreshed == {'appa': 2000, 'appb': 1000}
+    assert 'appb' in havoc.stale_pools
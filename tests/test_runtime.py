@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import socket
+import threading
+
+import pytest
+
+from havoc.core import Havoc
+from havoc.records import Backend
+from havoc.runtime import RuntimeAPI, RuntimeAPIError, plan_runtime_commands
+
+CONFIG = """global
+    stats socket /var/run/haproxy.sock mode 0600 level admin
+
+backend appa
+    balance roundrobin
+    server slot1 10.0.0.1:80 check
+    server slot2 10.0.0.2:80 check
+    server slot3 127.0.0.1:80 check disabled
+"""
+
+TEMPLATE = """global
+    stats socket /var/run/haproxy.sock mode 0600 level admin
+
+{% for pool in instances|sort %}backend {{pool}}
+{% for i in instances[pool] %}    server slot{{loop.index}} {{i.ip_address}}:80 check
+{% endfor %}{% endfor %}"""
+
+
+class FakeStatsSocket(object):
+    """
+    HAproxy stats socket answering one command per connection
+    """
+
+    def __init__(self, path, answer=''):
+        self.path = path
+        self.answer = answer
+        self.received = []
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(5)
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            with conn:
+                command = conn.recv(4096).decode().strip()
+                self.received.append(command)
+                conn.sendall((self.answer + '\n').encode())
+
+    def close(self):
+        self.server.close()
+
+
+@pytest.fixture
+def stats_socket(tmp_path):
+    sockets = []
+
+    def start(name='haproxy.sock', answer=''):
+        fake = FakeStatsSocket(str(tmp_path / name), answer)
+        sockets.append(fake)
+        return fake
+    yield start
+    for fake in sockets:
+        fake.close()
+
+
+def test_plan_set_server_addr():
+    new = CONFIG.replace('10.0.0.2:80', '10.0.0.9:8080')
+    assert plan_runtime_commands(CONFIG, new) == ['set server appa/slot2 addr 10.0.0.9 port 8080']
+
+
+def test_plan_set_server_addr_without_port():
+    old = CONFIG.replace('10.0.0.1:80', '10.0.0.1')
+    new = CONFIG.replace('10.0.0.1:80', '10.0.0.5')
+    assert plan_runtime_commands(old, new) == ['set server appa/slot1 addr 10.0.0.5']
+
+
+def test_plan_set_server_state():
+    new = CONFIG.replace('127.0.0.1:80 check disabled', '10.0.0.3:80 check')
+    assert plan_runtime_commands(CONFIG, new) == [
+        'set server appa/slot3 addr 10.0.0.3 port 80',
+        'set server appa/slot3 state ready',
+    ]
+    assert plan_runtime_commands(new, CONFIG) == [
+        'set server appa/slot3 addr 127.0.0.1 port 80',
+        'set server appa/slot3 state maint',
+    ]
+
+
+def test_plan_no_change():
+    assert plan_runtime_commands(CONFIG, CONFIG) == []
+
+
+def test_plan_added_server_needs_reload():
+    new = CONFIG + '    server slot4 10.0.0.4:80 check\n'
+    assert plan_runtime_commands(CONFIG, new) is None
+
+
+def test_plan_structural_change_needs_reload():
+    new = CONFIG.replace('roundrobin', 'leastconn')
+    assert plan_runtime_commands(CONFIG, new) is None
+
+
+def test_runtime_api_sends_commands_to_every_socket(stats_socket):
+    first = stats_socket('haproxy-0.sock')
+    second = stats_socket('haproxy-1.sock', answer='IP changed from 10.0.0.2 to 10.0.0.9 by stats socket command')
+    commands = ['set server appa/slot2 addr 10.0.0.9 port 80', 'set server appa/slot3 state ready']
+
+    RuntimeAPI([first.path, second.path], timeout=1).apply(commands)
+
+    assert first.received == commands
+    assert second.received == commands
+
+
+def test_runtime_api_refused_command(stats_socket):
+    fake = stats_socket(answer='No such server.')
+    with pytest.raises(RuntimeAPIError):
+        RuntimeAPI([fake.path], timeout=1).apply(['set server appa/slot9 state ready'])
+
+
+def test_runtime_api_missing_socket(tmp_path):
+    with pytest.raises(RuntimeAPIError):
+        RuntimeAPI([str(tmp_path / 'missing.sock')], timeout=1).apply(['set server appa/slot1 state ready'])
+
+
+def make_havoc(tmp_path, sockets):
+    template = tmp_path / 'haproxy.tmpl'
+    template.write_text(TEMPLATE)
+    options = {
+        'haproxy_cfg': str(tmp_path / 'haproxy.cfg'),
+        'template': str(template),
+        'pools': 'appa',
+        'dry_run': False,
+        'runtime_api': True,
+        'haproxy_sockets': ','.join(sockets),
+        'runtime_timeout': 1,
+    }
+    havoc = Havoc(None, None, options, logging.getLogger('havoc.test'))
+    havoc.reloads = []
+    havoc.reload_haproxy = lambda: havoc.reloads.append(True) or True
+    return havoc
+
+
+def build(havoc, *ips):
+    instances = {'appa': [Backend('web%d' % idx, ip, 'appa', 'static') for idx, ip in enumerate(ips)]}
+    return havoc.build_haproxy_conf(havoc.options['template'], instances, None, 1, 0)
+
+
+def test_membership_change_through_runtime_api(tmp_path, stats_socket):
+    fake = stats_socket()
+    havoc = make_havoc(tmp_path, [fake.path])
+    assert build(havoc, '10.0.0.1', '10.0.0.2')
+    assert len(havoc.reloads) == 1
+
+    assert build(havoc, '10.0.0.1', '10.0.0.9')
+    assert fake.received == ['set server appa/slot2 addr 10.0.0.9 port 80']
+    assert len(havoc.reloads) == 1
+    assert '10.0.0.9:80' in open(havoc.options['haproxy_cfg']).read()
+
+
+def test_runtime_api_failure_falls_back_to_reload(tmp_path, stats_socket):
+    fake = stats_socket(answer='No such server.')
+    havoc = make_havoc(tmp_path, [fake.path])
+    assert build(havoc, '10.0.0.1', '10.0.0.2')
+
+    assert build(havoc, '10.0.0.1', '10.0.0.9')
+    assert fake.received == ['set server appa/slot2 addr 10.0.0.9 port 80']
+    assert len(havoc.reloads) == 2
+
+
+def test_unreachable_socket_falls_back_to_reload(tmp_path):
+    havoc = make_havoc(tmp_path, [str(tmp_path / 'missing.sock')])
+    assert build(havoc, '10.0.0.1', '10.0.0.2')
+
+    assert build(havoc, '10.0.0.1', '10.0.0.9')
+    assert len(havoc.reloads) == 2
+
+
+def test_added_server_falls_back_to_reload(tmp_path, stats_socket):
+    fake = stats_socket()
+    havoc = make_havoc(tmp_path, [fake.path])
+    assert build(havoc, '10.0.0.1')
+
+    assert build(havoc, '10.0.0.1', '10.0.0.2')
+    assert fake.received == []
+    assert len(havoc.reloads) == 2
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import logging
+import socket
+
+import pytest
+
+from havoc.core import Havoc
+from havoc.records import Backend
+from havoc.share import InventoryPublisher, SharedInventory, start_share_server
+from havoc.snapshot import Snapshot
+
+log = logging.getLogger('havoc.test')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def inventory(*ips):
+    return {'appa': [Backend('web%d' % idx, ip, 'appa', 'aws', port=80, region='us-east-1') for idx, ip in enumerate(ips)]}
+
+
+@pytest.fixture
+def leader():
+    publisher = InventoryPublisher()
+    port = free_port()
+    server = start_share_server(publisher, port)
+    yield publisher, 'http://127.0.0.1:%d/inventory' % port
+    server.shutdown()
+    server.server_close()
+
+
+def test_publish_bumps_version_on_change_only():
+    publisher = InventoryPublisher()
+    assert publisher.publish(inventory('10.0.0.1'))
+    assert not publisher.publish(inventory('10.0.0.1'))
+    assert publisher.version == 1
+    assert publisher.publish(inventory('10.0.0.2'))
+    assert publisher.version == 2
+
+
+def test_follower_fetches_inventory(leader):
+    publisher, url = leader
+    publisher.publish(inventory('10.0.0.1', '10.0.0.2'), {'appb': 30})
+    follower = SharedInventory(url, timeout=2, log=log)
+
+    instances = follower.list_instances(['appa', 'appb'])
+
+    assert instances['appa'] == inventory('10.0.0.1', '10.0.0.2')['appa']
+    assert instances['appb'] == []
+    assert follower.version == 1
+    assert follower.stale == {'appb': 30}
+
+
+def test_follower_gets_not_modified(leader):
+    publisher, url = leader
+    publisher.publish(inventory('10.0.0.1'))
+    follower = SharedInventory(url, timeout=2, log=log)
+
+    assert follower.fetch()
+    etag = follower.etag
+    assert etag == publisher.etag
+    assert not follower.fetch()
+    assert follower.etag == etag
+    assert follower.list_instances(['appa']) == inventory('10.0.0.1')
+
+    publisher.publish(inventory('10.0.0.9'))
+    assert follower.fetch()
+    assert follower.etag != etag
+    assert follower.list_instances(['appa']) == inventory('10.0.0.9')
+
+
+def test_leader_without_inventory(leader):
+    _, url = leader
+    follower = SharedInventory(url, timeout=2, log=log)
+    with pytest.raises(Exception):
+        follower.fetch()
+
+
+def test_follower_falls_back_to_snapshot_when_leader_is_down(tmp_path):
+    snapshot = Snapshot(str(tmp_path / 'snapshot.gz'), log)
+    snapshot.update('leader', inventory('10.0.0.1'))
+    snapshot.save()
+    options = {
+        'pools': 'appa',
+        'snapshot_file': snapshot.path,
+        'snapshot_max_age': 3600,
+    }
+    follower = SharedInventory('http://127.0.0.1:%d/inventory' % free_port(), timeout=1, log=log)
+    havoc = Havoc(None, None, options, log, leader=follower)
+
+    instances = havoc.refresh(['appa'])
+
+    assert havoc.discovery_errors == 1
+    assert [(b.name, b.ip, b.port, b.region) for b in instances['appa']] == [('web0', '10.0.0.1', 80, 'us-east-1')]
+    assert 'appa' in havoc.stale_pools
+    assert 'appa' not in havoc.pool_refreshed
+
+
+def test_follower_keeps_previous_pools_when_leader_goes_down(leader):
+    publisher, url = leader
+    publisher.publish(inventory('10.0.0.1'))
+    follower = SharedInventory(url, timeout=1, log=log)
+    havoc = Havoc(None, None, {'pools': 'appa'}, log, leader=follower)
+    assert havoc.refresh(['appa'], now=1000) == inventory('10.0.0.1')
+
+    follower.url = 'http://127.0.0.1:%d/inventory' % free_port()
+    instances = havoc.refresh(['appa'], now=2000)
+
+    assert havoc.discovery_errors == 1
+    assert instances == inventory('10.0.0.1')
+    assert havoc.stale_pools == {'appa': 1000}
+    assert havoc.pool_refreshed == {'appa': 1000}
@@ -1,42 +1,170 @@
 #!/usr/bin/env python
 """
 HAvOC (HAproxy clOud Configuration)
-Generate HAproxy Configuration based on AWS/OpenStack API
+Tag the AWS instances and OpenStack servers whose hostname starts with a prefix,
+so HAvOC picks them in a pool.
+
+EC2 instances are tagged in batches of --batch-size instances per CreateTags
+call and OpenStack metadata are set by --workers concurrent requests.
+Instances already holding the tag are skipped, and the ids tagged are
+appended to --resume-file after every batch so an interrupted run restarts
+where it stopped. The resume file is only used for the tag it was written
+for, and is removed once a run completes.
 """
 
-__version = 0.2
+__version = 0.3
 
 import logging, os, sys, re
-import socket
+import threading
 
-from subprocess import call
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from optparse import OptionParser
 
-try:
-    import boto.ec2
-    AWS = True
-except:
-    AWS = False
-
-try:
-    from novaclient import client
-    NOVA = True
-except:
-    NOVA = False
-
-# Define command line options
-getopt = OptionParser(version="%%prog %s" % __version,
-    usage="Usage: %prog [options]")
-getopt.add_option("-i", "--access_key_id", dest="access_key_id", type="string", metavar="ACCESS_KEY_ID",
-    help="AWS ACCESS KEY ID")
-getopt.add_option("-s", "--access_key_secret", dest="access_key_secret", type="string", metavar="ACCESS_KEY_SECRET",
-    help="AWS ACCESS KEY SECRET")
-getopt.add_option("-r", "--overflow-aws-region", dest="overflow_aws_region", type="string", metavar="REGION",
-    help="OVERFLOW AWS REGION")
-getopt.add_option("-z", "--overflow-aws-zone", dest="overflow_aws_zone", type="string", metavar="ZONE",
-    help="OVERFLOW AWS ZONE")
-
-if NOVA:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+
+from havoc.providers import get_provider
+
+EC2_PAGE_SIZE = 1000
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level='INFO')
+log = logging.getLogger('havoc.tagger')
+
+
+class Progress(object):
+    """
+    Ids done so far, appended to the resume file when there is one. The first
+    line of the file holds the tag the ids were tagged with.
+    """
+
+    def __init__(self, path=None, tag_key=None, tag_value=None):
+        self.path = path
+        self.header = 'tag\t%s\t%s' % (tag_key, tag_value)
+        self.done = set()
+        self.lock = threading.Lock()
+        # The file is started over when it is missing or for another tag
+        self.resuming = False
+        if path and os.path.isfile(path):
+            with open(path, 'r') as handle:
+                lines = [line.rstrip('\n') for line in handle]
+            if lines and lines[0] == self.header:
+                self.done = set(line.strip() for line in lines[1:] if line.strip())
+                self.resuming = True
+                log.info("Resuming after %d tagged instances from %s", len(self.done), path)
+            else:
+                log.warning("Ignoring %s, written for another tag than %s => %s", path, tag_key, tag_value)
+
+    def add(self, ids):
+        with self.lock:
+            self.done.update(ids)
+            if self.path:
+                with open(self.path, 'a' if self.resuming else 'w') as handle:
+                    if not self.resuming:
+                        handle.write(self.header + '\n')
+                        self.resuming = True
+                    handle.write(''.join('%s\n' % i for i in ids))
+
+    def complete(self):
+        """
+        Remove the resume file once every instance has been tagged
+        """
+        if self.path and os.path.isfile(self.path):
+            os.unlink(self.path)
+
+
+def batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def plan_ec2(ec2, prefix, zone, tag_key, tag_value, progress):
+    """
+    Return the instances to tag, leaving out the ones already tagged
+    """
+    filters = {'tag:hostname': prefix + '*'}
+    if zone is not None:
+        filters['availability_zone'] = zone
+    todo = []
+    next_token = None
+    while True:
+        res = ec2.get_all_reservations(filters=filters, max_results=EC2_PAGE_SIZE, next_token=next_token)
+        for r in res:
+            for i in r.instances:
+                if i.tags.get(tag_key) == tag_value or i.id in progress.done:
+                    continue
+                todo.append(i)
+        next_token = getattr(res, 'next_token', None)
+        if not next_token:
+            return todo
+
+
+def plan_nova(nova, prefix, tag_key, tag_value, progress):
+    """
+    Return the servers to tag, leaving out the ones already tagged
+    """
+    # XXX: filtering on metadata in OpenStack is currently not working, the
+    # servers are filtered locally.
+    todo = []
+    for i in nova.servers.list(search_opts={'all_tenants': 0}):
+        if 'hostname' not in i.metadata or not i.metadata['hostname'].startswith(prefix):
+            continue
+        if i.metadata.get(tag_key) == tag_value or i.id in progress.done:
+            continue
+        todo.append(i)
+    return todo
+
+
+def tag_ec2(ec2, instances, tags, batch_size, progress):
+    """
+    Tag the instances with one CreateTags call per batch
+    """
+    total = len(instances)
+    count = 0
+    for number, batch in enumerate(batches(instances, batch_size), 1):
+        ids = [i.id for i in batch]
+        ec2.create_tags(ids, tags)
+        progress.add(ids)
+        count += len(ids)
+        log.info("EC2 : %d/%d instances tagged (batch %d/%d)", count, total, number, (total + batch_size - 1) // batch_size)
+
+
+def tag_nova(nova, servers, tags, workers, progress):
+    """
+    Set the metadata of the servers with workers concurrent requests.
+    Return the number of failures.
+    """
+    total = len(servers)
+    count = 0
+    failures = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(nova.servers.set_meta, i.id, tags), i) for i in servers)
+        for future in as_completed(futures):
+            server = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                log.error("Openstack : cannot tag %s : %s", server.name, e)
+                failures += 1
+                continue
+            progress.add([server.id])
+            count += 1
+            if count % 50 == 0 or count == total:
+                log.info("Openstack : %d/%d servers tagged", count, total)
+    return failures
+
+
+if __name__ == "__main__":
+
+    # Define command line options
+    getopt = OptionParser(version="%%prog %s" % __version,
+        usage="Usage: %prog [options]")
+    getopt.add_option("-i", "--access_key_id", dest="access_key_id", type="string", metavar="ACCESS_KEY_ID",
+        help="AWS ACCESS KEY ID")
+    getopt.add_option("-s", "--access_key_secret", dest="access_key_secret", type="string", metavar="ACCESS_KEY_SECRET",
+        help="AWS ACCESS KEY SECRET")
+    getopt.add_option("-r", "--overflow-aws-region", dest="overflow_aws_region", type="string", metavar="REGION",
+        help="OVERFLOW AWS REGION")
+    getopt.add_option("-z", "--overflow-aws-zone", dest="overflow_aws_zone", type="string", metavar="ZONE",
+        help="OVERFLOW AWS ZONE")
     getopt.add_option("-a", "--os-auth-url", dest="os_auth_url", type="string", metavar="AUTH_URL",
         help="OS AUTH URL")
     getopt.add_option("-u", "--os-username", dest="os_username", type="string", metavar="USERNAME",
@@ -45,47 +173,73 @@ if NOVA:
         help="OS API KEY")
     getopt.add_option("-P", "--os-project-id", dest="os_project_id", type="string", metavar="PROJECT_ID",
         help="OS PROJECT ID")
-
-getopt.add_option("-p", "--prefix", dest="prefix", type="string", metavar="HOSTNAME_PREFIX",
+    getopt.add_option("-p", "--prefix", dest="prefix", type="string", metavar="HOSTNAME_PREFIX",
         help="Hostname Prefix")
-getopt.add_option("-t", "--tag", dest="tag_key", type="string", metavar="TAG_KEY",
+    getopt.add_option("-t", "--tag", dest="tag_key", type="string", metavar="TAG_KEY",
         help="Tag Key")
-getopt.add_option("-v", "--value", dest="tag_value", type="string", metavar="TAG_VALUE",
+    getopt.add_option("-v", "--value", dest="tag_value", type="string", metavar="TAG_VALUE",
         help="Tag Value")
+    getopt.add_option("-b", "--batch-size", dest="batch_size", type="int", default=200, metavar="SIZE",
+        help="EC2 instances per CreateTags call")
+    getopt.add_option("-w", "--workers", dest="workers", type="int", default=8, metavar="WORKERS",
+        help="Concurrent OpenStack metadata updates")
+    getopt.add_option("-R", "--resume-file", dest="resume_file", type="string", metavar="FILE",
+        help="File of the ids already tagged, to resume an interrupted run")
+    getopt.add_option("-n", "--dry-run", dest="dry_run", action="store_true", default=False,
+        help="Display what would be tagged without tagging")
+
+    (options, args) = getopt.parse_args()
+
+    if not all([options.prefix, options.tag_key, options.tag_value]):
+        print(getopt.format_help())
+        sys.exit(65)
+
+    # Same provider setup as HAvOC
+    config = {
+        'aws_access_key_id': options.access_key_id,
+        'aws_secret_access_key': options.access_key_secret,
+        'overflow_aws_region': options.overflow_aws_region,
+        'os_auth_url': options.os_auth_url,
+        'os_username': options.os_username,
+        'os_password': options.os_api_key,
+        'os_project_id': options.os_project_id,
+    }
+    ec2 = None
+    nova = None
+    if all([options.access_key_id, options.access_key_secret, options.overflow_aws_region]):
+        ec2 = get_provider('ec2').connect(config, log)
+    if all([options.os_auth_url, options.os_username, options.os_api_key, options.os_project_id]):
+        nova = get_provider('openstack').connect(config, log)
+
+    progress = Progress(options.resume_file, options.tag_key, options.tag_value)
+    tags = {options.tag_key: options.tag_value}
+    failures = 0
+
+    # AWS
+    if ec2 is not None:
+        instances = plan_ec2(ec2, options.prefix, options.overflow_aws_zone, options.tag_key, options.tag_value, progress)
+        log.info("EC2 : %d instances to tag in %d batches", len(instances), (len(instances) + options.batch_size - 1) // options.batch_size)
+        if options.dry_run:
+            for i in instances:
+                log.info("Would tag %s (%s) %s => %s", i.tags.get('hostname'), i.id, options.tag_key, options.tag_value)
+        else:
+            try:
+                tag_ec2(ec2, instances, tags, options.batch_size, progress)
+            except Exception as e:
+                log.error("EC2 : tagging failed, run again to resume : %s", e)
+                failures += 1
+
+    # OS
+    if nova is not None:
+        servers = plan_nova(nova, options.prefix, options.tag_key, options.tag_value, progress)
+        log.info("Openstack : %d servers to tag with %d workers", len(servers), options.workers)
+        if options.dry_run:
+            for i in servers:
+                log.info("Would tag %s (%s) %s => %s", i.name, i.id, options.tag_key, options.tag_value)
+        else:
+            failures += tag_nova(nova, servers, tags, options.workers, progress)
 
-(options, args) = getopt.parse_args();
-
-if not all([options.prefix, options.tag_key, options.tag_value]):
-    print getopt.format_help()
-    sys.exit(65)
-
-if not all([options.access_key_id, options.access_key_secret, options.overflow_aws_region]):
-    AWS = False
-if not all([options.os_auth_url, options.os_username, options.os_api_key, options.os_project_id]):
-    NOVA = False
-
-# Create services
-if AWS:
-    ec2 = boto.ec2.connect_to_region(options.overflow_aws_region, aws_access_key_id=options.access_key_id, aws_secret_access_key=options.access_key_secret)
-if NOVA:
-    nova = client.Client("2", auth_url=options.os_auth_url, username=options.os_username, api_key=options.os_api_key, project_id=options.os_project_id)
-
-# AWS
-if AWS:
-    filtering={'tag:hostname': options.prefix + '*'}
-    if options.overflow_aws_zone is not None:
-        filtering['availability_zone'] = options.overflow_aws_zone
-    res = ec2.get_all_instances(filters=filtering)
-    for r in res:
-        for i in r.instances:
-            print "Doing", i.tags['hostname'], "tag:", options.tag_key, "=>", options.tag_value
-            ec2.create_tags([i.id], {options.tag_key: options.tag_value})
-
-# OS
-# XXX: filtering on metadata in OpenStack is currently not working. Needs further investigation.
-if NOVA:
-    res = nova.servers.list(search_opts={'metadata': u'{"hostname":"%s"}'%options.prefix + '*', 'all_tenants': 0})
-    for i in res:
-        if 'hostname' in i.metadata and options.prefix in i.metadata['hostname']:
-            print "Doing", i.name, "tag:", options.tag_key, "=>", options.tag_value
-            nova.servers.set_meta(i.id, {options.tag_key: options.tag_value})
+    if failures:
+        sys.exit(1)
+    if not options.dry_run:
+        progress.complete()
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+'''
+Synthetic-fleet benchmark for HAvOC.
+
+Builds fake EC2 and Nova providers serving a generated fleet, then times every
+phase of a HAvOC cycle separately: discovery (Havoc.discover), template
+rendering, change detection against the installed configuration
+(Havoc.do_we_have_changes) and the production write path (Havoc.build_haproxy_conf:
+render streamed to a temporary file while hashing, then installed, the HAproxy
+reload being skipped). The peak memory of every phase is measured with
+tracemalloc in an extra run, apart from the timed ones.
+
+Arguments:
+
+  -s, --sizes:
+      Comma separated list of fleet sizes (number of instances).
+      Defaults to 100,1000,10000.
+
+  -p, --pools:
+      Number of pools the fleet is spread over. Defaults to 20.
+
+  -i, --iterations:
+      Number of timed runs of every phase. Defaults to 5.
+
+  -l, --latency:
+      Latency in seconds injected in every fake API call. Defaults to 0.
+
+  -m, --multi-ip:
+      Fraction of the Openstack servers having two fixed IPs. Defaults to 0.3.
+
+  -t, --template:
+      Template to render. Defaults to a template rendering one backend per pool.
+
+  -o, --output:
+      Write the results as JSON to this file.
+
+  -b, --baseline:
+      JSON results of a previous run. Exits with 1 when the median of a phase
+      is slower than the baseline by more than --tolerance.
+
+  --startup-modules:
+      Comma separated list of modules whose cold import time is measured in
+      fresh interpreters. Defaults to havoc.core,havoc.app, havoc.app being
+      the module of the havoc command line. Modules of OPTIONAL_MODULES missing
+      from the tree (havoc.config, imported by havoc.app) are replaced by
+      empty modules, so their own import cost is not measured, and the
+      stubbed modules are reported with the results.
+
+  --startup-runs:
+      Number of fresh interpreters per module (0 to skip). Defaults to 5.
+
+Example:
+
+  python tools/havoc_bench.py --sizes 1000,50000 --output bench.json
+  python tools/havoc_bench.py --sizes 1000,50000 --baseline bench.json
+'''
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import logging
+import subprocess
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+
+from havoc.core import Havoc
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level='INFO')
+
+DEFAULT_TEMPLATE = '''{% for pool in instances|sort %}
+backend {{pool}}
+    balance leastconn
+    {% for i in instances[pool]|sort(attribute='name') %}server {{i.name}} {{i.ip_address}}:80 check inter 20000 rise 2 fall 6
+    {% endfor %}
+{% endfor %}
+'''
+
+PHASES = ('discovery', 'render', 'changes', 'write')
+
+# Provider and daemon libraries which should only be imported when used
+HEAVY_MODULES = ('boto', 'novaclient', 'daemon', 'yaml')
+
+# HAvOC modules replaced by empty modules when they are missing from the tree
+OPTIONAL_MODULES = ('havoc.config',)
+
+STARTUP_SCRIPT = '''
+import json, sys, time, types
+for name in %r:
+    stub = types.ModuleType(name)
+    stub.__getattr__ = lambda attribute: None
+    sys.modules[name] = stub
+started = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - started
+print(json.dumps({'seconds': elapsed, 'heavy': [m for m in %r if m in sys.modules]}))
+'''
+
+
+class FakeEC2Instance(object):
+
+    def __init__(self, idx, pool):
+        self.id = 'i-%08x' % idx
+        self.tags = {'pool': pool, 'hostname': 'ec2-node-%06d' % idx, 'vpc': 'bench'}
+        self.public_dns_name = 'ec2-%d.compute.amazonaws.com' % idx
+        self.ip_address = '10.%d.%d.%d' % (idx >> 16 & 255, idx >> 8 & 255, idx & 255)
+        self.placement = 'us-east-1%s' % 'abcd'[idx % 4]
+
+
+class FakeReservation(object):
+
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class FakeResultSet(list):
+    next_token = None
+
+
+class FakeEC2(object):
+    '''
+    Serve get_all_reservations with tag:pool filtering and NextToken pagination
+    '''
+
+    def __init__(self, instances, latency=0):
+        self.instances = instances
+        self.latency = latency
+        self.calls = 0
+
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        pools = filters['tag:pool']
+        pools = set([pools] if isinstance(pools, str) else pools)
+        matching = [i for i in self.instances if i.tags['pool'] in pools]
+        start = int(next_token or 0)
+        size = max_results or len(matching)
+        res = FakeResultSet([FakeReservation([copy.copy(i) for i in matching[start:start + size]])])
+        if start + size < len(matching):
+            res.next_token = str(start + size)
+        return res
+
+
+class FakeServer(object):
+
+    def __init__(self, idx, pool, multi_ip):
+        self.id = 'server-%08d' % idx
+        self.name = 'os-node-%06d' % idx
+        self.metadata = {'pool': pool}
+        self.addresses = {'private': [{'OS-EXT-IPS:type': 'fixed', 'addr': '172.16.%d.%d' % (idx >> 8 & 255, idx & 255)}]}
+        if multi_ip:
+            self.addresses['storage'] = [{'OS-EXT-IPS:type': 'fixed', 'addr': '172.17.%d.%d' % (idx >> 8 & 255, idx & 255)}]
+
+
+class FakeServerManager(object):
+    '''
+    Serve servers.list with marker/limit pagination
+    '''
+
+    def __init__(self, servers, latency=0):
+        self.servers = servers
+        self.positions = dict((s.id, n) for n, s in enumerate(servers))
+        self.latency = latency
+        self.calls = 0
+
+    def list(self, search_opts=None, marker=None, limit=None, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        start = self.positions[marker] + 1 if marker else 0
+        end = start + limit if limit else len(self.servers)
+        return [copy.copy(s) for s in self.servers[start:end]]
+
+
+class FakeNova(object):
+
+    def __init__(self, servers, latency=0):
+        self.servers = FakeServerManager(servers, latency)
+
+
+class BenchHavoc(Havoc):
+
+    def reload_haproxy(self):
+        return True
+
+
+def build_fleet(size, pools, multi_ip):
+    '''
+    Spread size instances over the pools, half on EC2 and half on Openstack
+    '''
+    names = ['pool-%03d' % n for n in range(pools)]
+    ec2 = [FakeEC2Instance(n, names[n % pools]) for n in range(0, size, 2)]
+    every = int(1 / multi_ip) if multi_ip else 0
+    nova = [FakeServer(n, names[n % pools], every and n % every == 1) for n in range(1, size, 2)]
+    return names, ec2, nova
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    rank = (len(values) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def measure(func, iterations):
+    '''
+    Time func over iterations runs, then run it once more under tracemalloc,
+    which would slow the timed runs down. Return the durations, the peak
+    memory and the last result.
+    '''
+    durations = []
+    result = None
+    for _ in range(iterations):
+        started = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return durations, peak, result
+
+
+def summarize(durations, peak, items):
+    median = percentile(durations, 50)
+    return {
+        'iterations': len(durations),
+        'mean': sum(durations) / len(durations),
+        'p50': median,
+        'p95': percentile(durations, 95),
+        'p99': percentile(durations, 99),
+        'max': max(durations),
+        'throughput': items / median if median else None,
+        'peak_memory': peak,
+    }
+
+
+def bench_fleet(size, args, template, workdir):
+    pools, ec2_instances, servers = build_fleet(size, args.pools, args.multi_ip)
+    ec2 = FakeEC2(ec2_instances, args.latency)
+    nova = FakeNova(servers, args.latency)
+    options = {
+        'pools': ','.join(pools),
+        'template': template,
+        'haproxy_cfg': os.path.join(workdir, 'haproxy-%d.cfg' % size),
+        'aws_vpc': None,
+        'overflow_aws_zone': None,
+        'log_send_hostname': None,
+        'cpus': 1,
+        'system_cpus': 0,
+        'dry_run': False,
+    }
+    log = logging.getLogger('havoc.bench')
+    log.setLevel(logging.WARNING)
+    havoc = BenchHavoc(ec2, nova, options, log)
+
+    results = {}
+    durations, peak, instances = measure(lambda: havoc.discover(pools), args.iterations)
+    results['discovery'] = summarize(durations, peak, size)
+    # The memory run makes one more discovery
+    results['discovery']['api_calls'] = (ec2.calls + nova.servers.calls) // (args.iterations + 1)
+
+    compiled = havoc.get_template(template)
+    render = lambda: compiled.render(instances=instances, hostname=None, cpu_count=1, cpu_reserved=0)
+    durations, peak, data = measure(render, args.iterations)
+    results['render'] = summarize(durations, peak, size)
+    results['render']['config_size'] = len(data)
+
+    # Compare with an installed configuration, hashed again on every run as
+    # on the first cycle of HAvOC
+    havoc.write_config(options['haproxy_cfg'], data)
+
+    def changes():
+        havoc.digests.pop(options['haproxy_cfg'], None)
+        return havoc.do_we_have_changes(data)
+    durations, peak, _ = measure(changes, args.iterations)
+    results['changes'] = summarize(durations, peak, size)
+
+    def write():
+        # Force the install of the configuration on every run
+        havoc.digests[options['haproxy_cfg']] = ''
+        return havoc.build_haproxy_conf(template, instances, None, 1, 0)
+    durations, peak, _ = measure(write, args.iterations)
+    results['write'] = summarize(durations, peak, size)
+    return results
+
+
+def bench_startup(module, runs):
+    '''
+    Time the import of module in fresh interpreters and report the heavy
+    libraries it pulled in
+    '''
+    root = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../')
+    stubs = [name for name in OPTIONAL_MODULES
+             if not os.path.exists(os.path.join(root, *name.split('.')) + '.py')
+             and not os.path.isdir(os.path.join(root, *name.split('.')))]
+    durations = []
+    heavy = []
+    for _ in range(runs):
+        try:
+            output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT % (stubs, module, HEAVY_MODULES)],
+                                             cwd=root, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            logging.error("Cannot import %s : %s", module, e.output.decode().strip().splitlines()[-1])
+            return None
+        run = json.loads(output.decode().strip().splitlines()[-1])
+        durations.append(run['seconds'])
+        heavy = run['heavy']
+    stats = summarize(durations, 0, 1)
+    stats['heavy_modules'] = heavy
+    stats['stubbed_modules'] = stubs
+    return stats
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Return the list of phases whose median regressed against the baseline
+    '''
+    regressions = []
+    for size, phases in results['fleets'].items():
+        for phase, stats in phases.items():
+            try:
+                reference = baseline['fleets'][size][phase]['p50']
+            except KeyError:
+                continue
+            if reference and stats['p50'] > reference * (1 + tolerance):
+                regressions.append((size, phase, reference, stats['p50']))
+    for module, stats in results.get('startup', {}).items():
+        try:
+            reference = baseline['startup'][module]['p50']
+        except KeyError:
+            continue
+        if reference and stats['p50'] > reference * (1 + tolerance):
+            regressions.append(('import', module, reference, stats['p50']))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    opts = argparse.ArgumentParser(description='Benchmarks HAvOC on synthetic fleets.')
+
+    opts.add_argument('-s', '--sizes', dest='sizes', default='100,1000,10000',
+                      help="Comma separated list of fleet sizes")
+    opts.add_argument('-p', '--pools', dest='pools', type=int, default=20,
+                      help="Number of pools")
+    opts.add_argument('-i', '--iterations', dest='iterations', type=int, default=5,
+                      help="Number of timed runs of every phase")
+    opts.add_argument('-l', '--latency', dest='latency', type=float, default=0,
+                      help="Latency in seconds injected in every API call")
+    opts.add_argument('-m', '--multi-ip', dest='multi_ip', type=float, default=0.3,
+                      help="Fraction of Openstack servers with two fixed IPs")
+    opts.add_argument('-t', '--template', dest='template', default=None,
+                      help="Template to render")
+    opts.add_argument('-o', '--output', dest='output', default=None,
+                      help="Write the results as JSON to this file")
+    opts.add_argument('-b', '--baseline', dest='baseline', default=None,
+                      help="JSON results to compare with")
+    opts.add_argument('--tolerance', dest='tolerance', type=float, default=0.2,
+                      help="Allowed slowdown against the baseline (0.2 for 20%%)")
+    opts.add_argument('--startup-modules', dest='startup_modules', default='havoc.core,havoc.app',
+                      help="Comma separated list of modules whose import is timed")
+    opts.add_argument('--startup-runs', dest='startup_runs', type=int, default=5,
+                      help="Number of fresh interpreters per module (0 to skip)")
+
+    args = opts.parse_args()
+    workdir = tempfile.mkdtemp(prefix='havoc-bench-')
+    template = args.template
+    if template is None:
+        template = os.path.join(workdir, 'bench.tmpl')
+        with open(template, 'w') as handle:
+            handle.write(DEFAULT_TEMPLATE)
+
+    results = {
+        'settings': {'pools': args.pools, 'iterations': args.iterations, 'latency': args.latency, 'multi_ip': args.multi_ip},
+        'fleets': {},
+    }
+    for size in [int(s) for s in args.sizes.split(',')]:
+        results['fleets'][str(size)] = bench_fleet(size, args, template, workdir)
+        for phase in PHASES:
+            stats = results['fleets'][str(size)][phase]
+            logging.info("%6d instances - %-9s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  %10.0f inst/s  peak %7.1f MB",
+                         size, phase, stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000,
+                         stats['throughput'] or 0, stats['peak_memory'] / 1048576.0)
+
+    if args.startup_runs:
+        results['startup'] = {}
+        for module in args.startup_modules.split(','):
+            stats = bench_startup(module, args.startup_runs)
+            if stats is None:
+                continue
+            results['startup'][module] = stats
+            logging.info("import %-22s p50 %8.2f ms  p95 %8.2f ms  heavy modules : %s  stubbed : %s",
+                         module, stats['p50'] * 1000, stats['p95'] * 1000, ','.join(stats['heavy_modules']) or 'none',
+                         ','.join(stats['stubbed_modules']) or 'none')
+
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+        logging.info("Results written to %s", args.output)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as handle:
+            baseline = json.load(handle)
+        regressions = compare(results, baseline, args.tolerance)
+        for size, phase, reference, current in regressions:
+            logging.error("Regression on %s %s : p50 %.2f ms (baseline %.2f ms)",
+                          size if size == 'import' else '%s instances -' % size, phase, current * 1000, reference * 1000)
+        if regressions:
+            sys.exit(1)
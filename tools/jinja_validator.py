@@ -30,8 +30,25 @@ Arguments:
       If not specified and no '.rendered' file exist, only the fact that the
       render completes will be checked (aka. only a syntax check is done)
 
+  -j, --jobs:
+      Number of processes rendering the templates. Defaults to the number of
+      CPUs.
+
+  -c, --cache-dir:
+      Directory of the compiled templates cache shared by the processes.
+      Defaults to a temporary directory.
+
+Templates are rendered with the same Jinja2 environment and filters as HAvOC.
+Every yaml file is parsed once and shared with the processes, and the render
+time and output size of every template are reported, slowest first.
+
 Changelog:
 
+2026-10-18 Release 0.2.0:
+ - Rendering across a process pool with shared yaml variables and compiled
+   templates
+ - Registering the HAvOC filters
+ - Reporting render time and output size of every template
 2016-02-10 Release 0.1.1:
  - Adding the support of dynamic expected render result files
  - Adding some documentation
@@ -40,10 +57,18 @@ Changelog:
 '''
 import os
 import sys
+import time
 import argparse
 import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import yaml
-from jinja2 import Environment
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '../'))
+
+from havoc.filters import render_scope
+from havoc.templating import build_environment
 
 # The default root environment is one step before the directory of this script
 ROOT_ENV = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../')
@@ -51,45 +76,67 @@ ROOT_ENV = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../')
 DEFAULT_YAML = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'jinja_validator.yaml')
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level='INFO')
 
-def validate_template(tmpl, tmpl_vars, expected_result):
+# Per process state, set by init_worker
+_env = None
+_variables = {}
+
+
+def init_worker(variables, cache_dir):
+    '''
+    Build the Jinja2 environment of a process and keep the parsed yaml
+    variables shared by every template
+    '''
+    global _env, _variables
+    _env = build_environment(cache_dir)
+    _variables = variables
+
+
+def validate_template(tmpl, yaml_file, expected_file):
     '''
     This function tries to render the template you give as parameter.
 
     Parameters:
-      - tmpl: the name of the template to try to render
-      - tmpl_vars: the variables to use with the template
-      - end_result: A string containing exactly what the end result should look
-        like
+      - tmpl: the path of the template to try to render
+      - yaml_file: the yaml file holding the variables to use with the template
+      - expected_file: A file containing exactly what the end result should
+        look like, or None
+
+    Returns (template, success, render time, output size).
     '''
-    with open(tmpl, 'r') as handle:
-        template_source = handle.read()
-        env = Environment()
-        template = env.from_string(template_source)
-        try:
-            rend = template.render(tmpl_vars)
-
-            if len(expected_result) > 0 and rend != expected_result:
-                tempfile = '/tmp/last_rendering_err.log'
-                with open(tempfile, 'w') as tmpfile:
-                    tmpfile.write(rend)
-                    logging.info("The rendered file has been dumped to %s", tempfile)
-                logging.error("Unable to render file %s as expected", tmpl)
-                return False
-            else:
-                logging.info("Template %s rendered successfully", tmpl)
-                return True
-        except Exception as ex:
-            logging.error("Template tmpl failed with the error: %s", ex.message)
-            return False
-
-def process_file(root_folder, template_file, rendered_file):
+    started = time.perf_counter()
+    try:
+        template = _env.get_template(os.path.abspath(tmpl))
+        with render_scope():
+            rend = template.render(_variables[yaml_file] or {})
+    except Exception as ex:
+        logging.error("Template %s failed with the error: %s", tmpl, ex)
+        return tmpl, False, time.perf_counter() - started, 0
+    elapsed = time.perf_counter() - started
+
+    if expected_file is not None:
+        with open(expected_file, 'r') as handle:
+            expected_result = handle.read()
+        if len(expected_result) > 0 and rend != expected_result:
+            dump = os.path.join(tempfile.gettempdir(), 'last_rendering_err.%d.log' % os.getpid())
+            with open(dump, 'w') as tmpfile:
+                tmpfile.write(rend)
+                logging.info("The rendered file has been dumped to %s", dump)
+            logging.error("Unable to render file %s as expected", tmpl)
+            return tmpl, False, elapsed, len(rend)
+
+    logging.info("Template %s rendered successfully", tmpl)
+    return tmpl, True, elapsed, len(rend)
+
+
+def plan_file(root_folder, template_file, rendered_file):
     '''
-    Takes a template file and process it (grabs the corresponding variables from
-    the yaml, and call the validate_template function).
+    Takes a template file and returns what is needed to validate it : the
+    template path, the yaml file of its variables and the expected render.
 
     Parameters:
       - root_folder: the root directory of the template file
       - template_file: the filename of the template
+      - rendered_file: the expected render of the template, if any
     '''
     # Loading the variables from the yaml file of the template of
     # exists. If not, load from the default one.
@@ -97,24 +144,31 @@ def process_file(root_folder, template_file, rendered_file):
     if os.path.isfile(os.path.join(root_folder, template_file + '.jval.yaml')):
         yaml_file = os.path.join(root_folder, template_file + '.jval.yaml')
 
-    expected_render = ''
+    expected_render = None
     default_render_path = os.path.join(root_folder, template_file + '.rendered')
     # If a render file is specifile, take it.
     if len(rendered_file) > 0:
-        with open(rendered_file, 'r') as handle:
-            expected_render = handle.read()
+        expected_render = rendered_file
     # If not, try the default render file pattern
     elif os.path.isfile(default_render_path):
-        with open(default_render_path, 'r') as handle:
-            expected_render = handle.read()
+        expected_render = default_render_path
     else:
         logging.debug("No render file available. Will not compare the result.")
 
-    with open(yaml_file, 'r') as yfile:
-        template_variables = yaml.load(yfile)
-        logging.debug("Loaded from yaml: %r", template_variables)
-        return validate_template(os.path.join(root_folder, template_file),
-                                 template_variables, expected_render)
+    return os.path.join(root_folder, template_file), yaml_file, expected_render
+
+
+def load_variables(yaml_files):
+    '''
+    Parse every yaml file once
+    '''
+    variables = {}
+    for yaml_file in yaml_files:
+        with open(yaml_file, 'r') as yfile:
+            variables[yaml_file] = yaml.safe_load(yfile)
+            logging.debug("Loaded from yaml %s: %r", yaml_file, variables[yaml_file])
+    return variables
+
 
 if __name__ == "__main__":
 
@@ -131,24 +185,43 @@ if __name__ == "__main__":
     opts.add_argument('-f', '--template-final', dest='template_final',
                       metavar='TEMPLATE_FINAL', default='',
                       help="If specified with the --template option, will check that the render of the template will look like the value of the file specified.")
+    opts.add_argument('-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                      help="Number of processes rendering the templates")
+    opts.add_argument('-c', '--cache-dir', dest='cache_dir', default=None,
+                      help="Directory of the compiled templates cache shared by the processes")
 
     args = opts.parse_args()
-    returned_status = True
+    jobs = []
     if args.template:
         if os.path.isfile(args.template):
-            returned_status = process_file(
+            jobs.append(plan_file(
                 os.path.dirname(args.template),
                 os.path.basename(args.template),
-                args.template_final)
-            if not returned_status:
-                sys.exit(1)
+                args.template_final))
         else:
             logging.error("Invalid template path: %s", args.template)
             sys.exit(1)
     else:
         for root, dirs, files in os.walk(args.root_dir):
-            for f in files:
+            for f in sorted(files):
                 if f.endswith(".tmpl"):
-                    returned_status = process_file(root, f, args.template_final)
-                    if not returned_status:
-                        sys.exit(1)
+                    jobs.append(plan_file(root, f, args.template_final))
+
+    try:
+        variables = load_variables(set(yaml_file for _, yaml_file, _ in jobs))
+    except (IOError, OSError, yaml.YAMLError) as ex:
+        logging.error("Unable to load the template variables: %s", ex)
+        sys.exit(1)
+
+    # Without --cache-dir, the cache only lives for this run
+    with tempfile.TemporaryDirectory(prefix='jinja-validator-') as tmp_dir:
+        cache_dir = args.cache_dir or tmp_dir
+        with ProcessPoolExecutor(max_workers=max(1, min(args.jobs or 1, len(jobs) or 1)),
+                                 initializer=init_worker, initargs=(variables, cache_dir)) as executor:
+            results = list(executor.map(validate_template, *zip(*jobs))) if jobs else []
+
+    for tmpl, success, elapsed, size in sorted(results, key=lambda r: r[2], reverse=True):
+        logging.info("%-60s %s %9.2f ms %10d bytes", tmpl, 'OK  ' if success else 'FAIL', elapsed * 1000, size)
+
+    if not all(success for _, success, _, _ in results):
+        sys.exit(1)